@@ -1,11 +1,25 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import json
+import time
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from dotenv import load_dotenv
-from pydantic import BaseModel, Base64Str
+from pydantic import BaseModel
 from typing import Optional
-from google import genai
 import os
-from app_utils import get_llm_response
+from app_utils import (
+    aget_llm_response,
+    answer_cache,
+    astream_llm_response,
+    close_async_clients,
+    embedding_cache,
+    gemini_breaker,
+    invalidate_answer_cache,
+    warm_up,
+)
+from query_images import InvalidImageError, ImageTooLargeError
+from resilience import StageTimeoutError
+from metrics import render_metrics, request_latency, server_timing_header, start_request
 
 
 class InputRequest(BaseModel):
@@ -21,20 +35,97 @@ class UrlSource(BaseModel):
 class QueryResponse(BaseModel):
     answer: str
     links: list[UrlSource]
+    # True when generation was unavailable and only the links were retrieved
+    degraded: bool = False
+
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_async_clients()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
 )
 
+
+@app.middleware("http")
+async def timing(request: Request, call_next):
+    # Stages timed while handling the request end up in the Server-Timing header.
+    # Streaming responses send headers before generation, so they only carry
+    # the stages that finished by then.
+    timings = start_request()
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    # Label by route template rather than raw path to keep the series bounded
+    route = request.scope.get("route")
+    request_latency.observe(elapsed, path=route.path if route else "unmatched")
+    response.headers["Server-Timing"] = server_timing_header(timings + [("total", elapsed)])
+    return response
+
+
 @app.post("/api/v1/query")
-def main(req: InputRequest) -> QueryResponse:
+async def main(req: InputRequest) -> QueryResponse:
     try:
-        return get_llm_response(req.question, req.image)
+        return await aget_llm_response(req.question, req.image)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except StageTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        return { 'answer': '', 'links': '' }
+        print(f"Query failed: {e!r}")
+        raise HTTPException(status_code=502, detail="Could not answer the question, please retry")
+
+
+@app.post("/api/v1/query/stream")
+async def stream(req: InputRequest):
+    # Server-sent events: "links" first, then "token" chunks (or "degraded"), then "done"
+    async def events():
+        try:
+            async for event, data in astream_llm_response(req.question, req.image):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/api/v1/cache/invalidate")
+def invalidate_cache(x_admin_token: Optional[str] = Header(None)):
+    # Called by ingestion after the index has been rebuilt. Only clears this
+    # worker; the others see the new index generation within INDEX_GENERATION_TTL.
+    admin_token = os.getenv("CACHE_ADMIN_TOKEN")
+    if not admin_token or x_admin_token != admin_token:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    invalidate_answer_cache()
+    return {"message": "invalidated"}
+
+
+@app.get("/api/v1/warmup")
+async def warmup():
+    # Optional: hit this after a deploy so the first real query finds ready clients
+    await warm_up()
+    return {"message": "warm"}
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(
+        render_metrics(
+            {"embedding": embedding_cache, "answer": answer_cache}, {"gemini": gemini_breaker}
+        ),
+        media_type="text/plain; version=0.0.4",
+    )
 
 
 @app.get("/")
@@ -1,10 +1,29 @@
-import requests
+import asyncio
+import hashlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 from dotenv import load_dotenv
 import os
-from pinecone import Pinecone
-from google import genai
 from typing import Literal
 import numpy as np
+from cache import SemanticCache, make_cache
+from vector_store import QuantizedIndex, fuse_results, load_local_index
+from context_packing import estimate_tokens, pack_context
+from query_images import prepare_query_images
+from batching import EmbeddingBatcher
+from coalescing import SingleFlight
+from metrics import coalesced_queries, degraded_answers, hedged_requests, prompt_tokens, stage
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    LatencyTracker,
+    current_deadline,
+    hedged,
+    within_deadline,
+)
 
 load_dotenv()
 
@@ -14,15 +33,340 @@ JINA_API_KEY = os.getenv("JINA_API_KEY")
 JINA_EMBEDDING_MODEL_NAME = os.getenv("JINA_EMBEDDING_MODEL_NAME")
 JINA_EMBEDDING_MODEL_DIMENSIONS = os.getenv("JINA_EMBEDDING_MODEL_DIMENSIONS")
 JINA_API_ENDPOINT = os.getenv("JINA_API_ENDPOINT")
+# Embedding backend: "jina" (hosted API) or "onnx" (local CPU model, see embeddings.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "jina")
+# Queries are embedded for retrieval against passages, on either backend
+EMBEDDING_TASK = "retrieval.query"
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
+# Data plane host of the index; skips the describe_index lookup when set
+PINECONE_HOST = os.getenv("PINECONE_HOST")
 
+# Retrieval backend: "pinecone", "local" (exact), "ivf" (approximate) or
+# "snapshot" (memory-mapped corpus snapshot written by ingestion)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "index.npz")
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "snapshot")
+# Quantized first pass over the local/snapshot index: "none", "int8" or "binary",
+# on the first QUANTIZED_DIM dimensions, rescoring RESCORE_K candidates
+QUANTIZATION = os.getenv("QUANTIZATION", "none")
+QUANTIZED_DIM = int(os.getenv("QUANTIZED_DIM", "256"))
+RESCORE_K = int(os.getenv("RESCORE_K", "100"))
+IVF_N_PROBE = int(os.getenv("IVF_N_PROBE", "8"))
+TOP_K = int(os.getenv("TOP_K", "10"))
 
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(PINECONE_INDEX_NAME)
+# Multimodal queries: "mean" averages text and image embeddings into one query,
+# "fusion" queries each separately in parallel and fuses the rankings
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "fusion")
+FUSION_METHOD = os.getenv("FUSION_METHOD", "rrf")
+FUSION_TEXT_WEIGHT = float(os.getenv("FUSION_TEXT_WEIGHT", "1.0"))
+FUSION_IMAGE_WEIGHT = float(os.getenv("FUSION_IMAGE_WEIGHT", "1.0"))
+RRF_K = int(os.getenv("RRF_K", "60"))
 
-llm_client = genai.Client(api_key=GEMINI_API_KEY)
+# Connection pool limits shared by every outbound HTTP call to Jina
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+
+# Query embedding cache: "memory", "disk" or "none"
+EMBEDDING_CACHE_BACKEND = os.getenv("EMBEDDING_CACHE_BACKEND", "memory")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+
+# Micro-batching of concurrent query embeddings into one upstream request
+EMBEDDING_BATCH_ENABLED = os.getenv("EMBEDDING_BATCH_ENABLED", "true").lower() == "true"
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+
+# Per-request deadline and per-stage caps, in seconds. A stage gets the
+# smaller of its cap and what is left of the deadline.
+QUERY_DEADLINE_SECONDS = float(os.getenv("QUERY_DEADLINE_SECONDS", "25"))
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "5"))
+RETRIEVE_TIMEOUT = float(os.getenv("RETRIEVE_TIMEOUT", "3"))
+GENERATE_TIMEOUT = float(os.getenv("GENERATE_TIMEOUT", "20"))
+# Send a second Jina/Pinecone request once the first is slower than that upstream's p95
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_INITIAL_DELAY_MS = float(os.getenv("HEDGE_INITIAL_DELAY_MS", "1000"))
+# Gemini circuit breaker; while open, queries get the retrieved links without an answer
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_RESET_SECONDS = float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "30"))
+FALLBACK_ANSWER = os.getenv(
+    "FALLBACK_ANSWER",
+    "The assistant cannot generate an answer right now. These forum posts look most relevant to your question.",
+)
+
+# Share one execution between concurrent identical queries
+QUERY_COALESCING_ENABLED = os.getenv("QUERY_COALESCING_ENABLED", "true").lower() == "true"
+
+# Semantic answer cache for near-duplicate questions
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "21600"))
+# Cached answers are tagged with the index generation that ingestion stamps
+# into Pinecone, so a re-index makes them stale on every instance. The stamp
+# is re-read at most every INDEX_GENERATION_TTL seconds.
+INDEX_GENERATION_TTL = float(os.getenv("INDEX_GENERATION_TTL", "60"))
+INDEX_GENERATION_NAMESPACE = os.getenv("INDEX_GENERATION_NAMESPACE", f"{PINECONE_NAMESPACE}-meta")
+INDEX_GENERATION_ID = "index-generation"
+
+
+# Clients are created on first use and then reused, so a cold start only pays
+# for the ones the first request actually reaches. The SDK imports are deferred
+# for the same reason.
+_pc = None
+_index = None
+_local_index = None
+_llm_client = None
+_session = None
+_embedding_runner = None
+
+
+def get_pinecone():
+    global _pc
+    if _pc is None:
+        from pinecone import Pinecone
+
+        _pc = Pinecone(api_key=PINECONE_API_KEY)
+    return _pc
+
+
+def get_index():
+    global _index
+    if _index is None:
+        if PINECONE_HOST:
+            _index = get_pinecone().Index(host=PINECONE_HOST)
+        else:
+            _index = get_pinecone().Index(PINECONE_INDEX_NAME)
+    return _index
+
+
+def get_local_index():
+    global _local_index
+    if _local_index is None:
+        kind = "exact" if VECTOR_BACKEND == "local" else VECTOR_BACKEND
+        path = SNAPSHOT_PATH if kind == "snapshot" else LOCAL_INDEX_PATH
+        _local_index = load_local_index(
+            path, kind, **({"n_probe": IVF_N_PROBE} if kind == "ivf" else {})
+        )
+        if QUANTIZATION != "none":
+            _local_index = QuantizedIndex(_local_index, QUANTIZATION, QUANTIZED_DIM, RESCORE_K)
+    return _local_index
+
+
+def get_llm_client():
+    global _llm_client
+    if _llm_client is None:
+        from google import genai
+
+        _llm_client = genai.Client(api_key=GEMINI_API_KEY)
+    return _llm_client
+
+
+def get_embedding_runner():
+    """Local ONNX embedder on its thread pool, for EMBEDDING_BACKEND=onnx."""
+    global _embedding_runner
+    if _embedding_runner is None:
+        from embeddings import MODEL_NAME, EmbeddingRunner, OnnxEmbedder
+
+        # The index was embedded through the API; only the same model shares its space
+        if JINA_EMBEDDING_MODEL_NAME and JINA_EMBEDDING_MODEL_NAME != MODEL_NAME.split("/")[-1]:
+            raise ValueError(
+                f"EMBEDDING_BACKEND=onnx runs {MODEL_NAME}, but the index was built with {JINA_EMBEDDING_MODEL_NAME}"
+            )
+        _embedding_runner = EmbeddingRunner(OnnxEmbedder())
+    return _embedding_runner
+
+
+def get_session():
+    """Keep-alive session for the sync path."""
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        _session = requests.Session()
+        _session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                pool_maxsize=HTTP_MAX_CONNECTIONS,
+            ),
+        )
+    return _session
+
+embedding_cache = make_cache(
+    EMBEDDING_CACHE_BACKEND,
+    maxsize=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    path=EMBEDDING_CACHE_PATH,
+)
+
+answer_cache = (
+    SemanticCache(
+        maxsize=ANSWER_CACHE_SIZE,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        ttl=ANSWER_CACHE_TTL,
+    )
+    if ANSWER_CACHE_ENABLED
+    else None
+)
+
+
+query_flights = SingleFlight()
+
+jina_latency = LatencyTracker(initial_delay=HEDGE_INITIAL_DELAY_MS / 1000)
+pinecone_latency = LatencyTracker(initial_delay=HEDGE_INITIAL_DELAY_MS / 1000)
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    failure_threshold=GEMINI_BREAKER_FAILURES,
+    reset_timeout=GEMINI_BREAKER_RESET_SECONDS,
+)
+
+
+async def maybe_hedged(func, tracker: LatencyTracker, upstream: str):
+    if not HEDGE_ENABLED:
+        return await func()
+    return await hedged(func, tracker, on_hedge=lambda: hedged_requests.inc(upstream=upstream))
+
+
+def invalidate_answer_cache():
+    """Drops every cached answer, e.g. after the index has been re-ingested."""
+    if answer_cache is not None:
+        answer_cache.clear()
+
+
+# Last index generation read from Pinecone and when (monotonic seconds)
+_index_generation: dict = {"value": None, "read_at": None}
+generation_flights = SingleFlight()
+
+
+def generation_is_fresh() -> bool:
+    read_at = _index_generation["read_at"]
+    return read_at is not None and time.monotonic() - read_at < INDEX_GENERATION_TTL
+
+
+def remember_generation(response):
+    record = (getattr(response, "vectors", None) or {}).get(INDEX_GENERATION_ID)
+    metadata = getattr(record, "metadata", None) or {}
+    _index_generation["value"] = metadata.get("generation")
+
+
+def index_generation() -> str | None:
+    """
+    Version stamp of the Pinecone index, written by generate_embeddings after
+    every run that changed it. Local indexes are loaded once per process, so
+    their answers cannot outlive them and need no stamp. If the stamp cannot
+    be read, the last known one is kept.
+    """
+    if VECTOR_BACKEND != "pinecone" or generation_is_fresh():
+        return _index_generation["value"]
+    try:
+        remember_generation(
+            get_index().fetch(ids=[INDEX_GENERATION_ID], namespace=INDEX_GENERATION_NAMESPACE)
+        )
+    except Exception as e:
+        print(f"Could not read the index generation: {e!r}")
+    _index_generation["read_at"] = time.monotonic()
+    return _index_generation["value"]
+
+
+async def aindex_generation() -> str | None:
+    if VECTOR_BACKEND != "pinecone" or generation_is_fresh():
+        return _index_generation["value"]
+
+    async def read():
+        try:
+            response = await within_deadline(
+                (await get_async_index()).fetch(ids=[INDEX_GENERATION_ID], namespace=INDEX_GENERATION_NAMESPACE),
+                "generation",
+                RETRIEVE_TIMEOUT,
+            )
+            remember_generation(response)
+        except Exception as e:
+            print(f"Could not read the index generation: {e!r}")
+        _index_generation["read_at"] = time.monotonic()
+        return _index_generation["value"]
+
+    # Concurrent queries that find the stamp expired share one read
+    return await generation_flights.do(INDEX_GENERATION_ID, read)
+
+
+# Async clients are created on first use so they bind to the running event loop
+_async_http_client: httpx.AsyncClient | None = None
+_async_index = None
+_embedding_batcher = None
+_pinecone_host = PINECONE_HOST
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    global _async_http_client
+    if _async_http_client is None or _async_http_client.is_closed:
+        _async_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+    return _async_http_client
+
+
+def resolve_pinecone_host() -> str:
+    """Data plane host of the index; a blocking control plane call unless PINECONE_HOST is set."""
+    global _pinecone_host
+    if _pinecone_host is None:
+        _pinecone_host = get_pinecone().describe_index(PINECONE_INDEX_NAME).host
+    return _pinecone_host
+
+
+async def get_async_index():
+    global _async_index
+    if _async_index is None:
+        # The SDK import and the host lookup both block, so they run on a thread
+        pc = await asyncio.to_thread(get_pinecone)
+        host = _pinecone_host or await asyncio.to_thread(resolve_pinecone_host)
+        # Another coroutine may have created it in the meantime
+        if _async_index is None:
+            _async_index = pc.IndexAsyncio(host=host)
+    return _async_index
+
+
+async def close_async_clients():
+    global _async_http_client, _async_index, _embedding_runner, _embedding_batcher
+    if _embedding_batcher is not None:
+        await _embedding_batcher.close()
+        _embedding_batcher = None
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+    if _async_index is not None:
+        await _async_index.close()
+        _async_index = None
+    if _embedding_runner is not None:
+        _embedding_runner.close()
+        _embedding_runner = None
+
+
+async def warm_up():
+    """
+    Creates the clients the async query path needs ahead of the first
+    request, on the serving event loop. Slow imports and the Pinecone host
+    lookup run on threads so requests already being served are not blocked.
+    """
+    get_async_http_client()
+    await asyncio.to_thread(get_llm_client)
+    if EMBEDDING_BACKEND == "onnx":
+        await asyncio.to_thread(get_embedding_runner)
+    if VECTOR_BACKEND == "pinecone":
+        await get_async_index()
+    else:
+        await asyncio.to_thread(get_local_index)
 
 
 def get_prompt(context: str, question: str):
@@ -40,60 +384,385 @@ ANSWER:
 """
 
 
-def get_embeddings(inputs: list[dict[str, list[float]]], type: Literal['text', 'image']='text'):
+def get_embeddings_request(inputs: list[dict[str, str]]):
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {JINA_API_KEY}",
     }
     data = {
-        "task": "retrieval.query",
+        "task": EMBEDDING_TASK,
         "input": inputs,
         "model": JINA_EMBEDDING_MODEL_NAME,
         "dimensions": JINA_EMBEDDING_MODEL_DIMENSIONS,
     }
+    return headers, data
+
+
+def embedding_dimensions() -> int | None:
+    return int(JINA_EMBEDDING_MODEL_DIMENSIONS) if JINA_EMBEDDING_MODEL_DIMENSIONS else None
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def embedding_cache_key(item: dict[str, str]) -> str:
+    """
+    Cache key for a single Jina input: normalized text, or a hash of the image.
+    The model and dimensions are part of the key so a config change never
+    serves vectors from another embedding space.
+    """
+    if "text" in item:
+        content = "text:" + normalize_text(item["text"])
+    else:
+        content = "image:" + hashlib.sha256(item["image"].encode()).hexdigest()
+    return f"{EMBEDDING_BACKEND}:{EMBEDDING_TASK}:{JINA_EMBEDDING_MODEL_NAME}:{JINA_EMBEDDING_MODEL_DIMENSIONS}:{content}"
 
-    response = requests.post(JINA_API_ENDPOINT, headers=headers, json=data)
+
+def lookup_cached_embeddings(inputs: list[dict[str, str]]):
+    """
+    Returns (keys, cached embeddings with None for misses, indices of misses).
+    """
+    keys = [embedding_cache_key(x) for x in inputs]
+    if embedding_cache is None:
+        return keys, [None] * len(inputs), list(range(len(inputs)))
+    cached = [embedding_cache.get(key) for key in keys]
+    missing = [i for i, emb in enumerate(cached) if emb is None]
+    return keys, cached, missing
+
+
+def merge_embeddings(keys, cached, missing, fetched: list[dict]) -> list[dict]:
+    fetched = sorted(fetched, key=lambda x: x.get("index", 0))
+    for i, emb in zip(missing, fetched):
+        cached[i] = emb["embedding"]
+    if embedding_cache is not None and fetched:
+        # One write, so the disk backend commits once per request
+        embedding_cache.set_many({keys[i]: emb["embedding"] for i, emb in zip(missing, fetched)})
+    return [{"index": i, "embedding": emb} for i, emb in enumerate(cached)]
+
+
+async def off_loop_if_disk(func, *args):
+    """Runs a call that hits the embedding cache in a thread if that cache is SQLite."""
+    if EMBEDDING_CACHE_BACKEND == "disk":
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+def get_embeddings(inputs: list[dict[str, list[float]]], type: Literal['text', 'image']='text'):
+    keys, cached, missing = lookup_cached_embeddings(inputs)
+    if not missing:
+        return merge_embeddings(keys, cached, missing, [])
+
+    if EMBEDDING_BACKEND == "onnx":
+        fetched = get_embedding_runner().embed(
+            [inputs[i] for i in missing], truncate_dim=embedding_dimensions(), task=EMBEDDING_TASK
+        )
+        return merge_embeddings(keys, cached, missing, fetched)
+
+    headers, data = get_embeddings_request([inputs[i] for i in missing])
+
+    response = get_session().post(
+        JINA_API_ENDPOINT,
+        headers=headers,
+        json=data,
+        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT),
+    )
     if response.ok:
+        return merge_embeddings(keys, cached, missing, response.json()["data"])
+    raise ValueError("Unable to get embeddings from Jina")
+
+
+async def afetch_embeddings(inputs: list[dict[str, str]]) -> list[dict]:
+    """One upstream embedding call for inputs, bypassing cache and batcher."""
+    if EMBEDDING_BACKEND == "onnx":
+        return await get_embedding_runner().aembed(
+            inputs, truncate_dim=embedding_dimensions(), task=EMBEDDING_TASK
+        )
+
+    headers, data = get_embeddings_request(inputs)
+
+    async def post():
+        return await get_async_http_client().post(
+            JINA_API_ENDPOINT, headers=headers, json=data
+        )
+
+    response = await maybe_hedged(post, jina_latency, "jina")
+    if response.is_success:
         return response.json()["data"]
     raise ValueError("Unable to get embeddings from Jina")
 
 
+def get_embedding_batcher() -> EmbeddingBatcher:
+    global _embedding_batcher
+    if _embedding_batcher is None:
+        _embedding_batcher = EmbeddingBatcher(
+            afetch_embeddings,
+            max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+            max_wait=EMBEDDING_BATCH_MAX_WAIT_MS / 1000,
+            key=embedding_cache_key,
+        )
+    return _embedding_batcher
+
+
+async def aget_embeddings(inputs: list[dict[str, str]]):
+    keys, cached, missing = await off_loop_if_disk(lookup_cached_embeddings, inputs)
+    if not missing:
+        return merge_embeddings(keys, cached, missing, [])
+
+    missing_inputs = [inputs[i] for i in missing]
+    if EMBEDDING_BATCH_ENABLED:
+        fetched = await get_embedding_batcher().submit(missing_inputs)
+    else:
+        fetched = await afetch_embeddings(missing_inputs)
+    return await off_loop_if_disk(merge_embeddings, keys, cached, missing, fetched)
+
+
 def get_context(vector: list[float]) -> list[str]:
-    response = index.query(
-        top_k=10, vector=vector, namespace=PINECONE_NAMESPACE, include_metadata=True
+    vector_index = get_index() if VECTOR_BACKEND == "pinecone" else get_local_index()
+    response = vector_index.query(
+        top_k=TOP_K, vector=vector, namespace=PINECONE_NAMESPACE, include_metadata=True
     )
     return response
 
 
-def get_llm_response(question: str, image: str | list[str] | None=None):
+async def aget_context(vector: list[float]):
+    if VECTOR_BACKEND != "pinecone":
+        # In-memory search is sub-millisecond, no need to leave the event loop
+        return get_context(vector)
+    async def query():
+        return await (await get_async_index()).query(
+            top_k=TOP_K, vector=vector, namespace=PINECONE_NAMESPACE, include_metadata=True
+        )
+
+    return await maybe_hedged(query, pinecone_latency, "pinecone")
+
+
+def fusion_weights(count: int) -> list[float]:
+    # The first embedding is always the question text, the rest are images
+    return [FUSION_TEXT_WEIGHT] + [FUSION_IMAGE_WEIGHT] * (count - 1)
+
+
+def use_fusion(embeddings: list[dict]) -> bool:
+    return RETRIEVAL_MODE == "fusion" and len(embeddings) > 1
+
+
+def retrieve(embeddings: list[dict], vector: list[float]):
+    if not use_fusion(embeddings):
+        return get_context(vector)
+    vectors = [emb['embedding'] for emb in embeddings]
+    with ThreadPoolExecutor(max_workers=len(vectors)) as pool:
+        results = list(pool.map(get_context, vectors))
+    return fuse_results(
+        results, fusion_weights(len(vectors)), FUSION_METHOD, TOP_K, RRF_K
+    )
+
+
+async def aretrieve(embeddings: list[dict], vector: list[float]):
+    """Runs one top-k query per text/image vector concurrently and fuses them."""
+    if not use_fusion(embeddings):
+        return await aget_context(vector)
+    vectors = [emb['embedding'] for emb in embeddings]
+    results = await asyncio.gather(*(aget_context(v) for v in vectors))
+    return fuse_results(
+        results, fusion_weights(len(vectors)), FUSION_METHOD, TOP_K, RRF_K
+    )
+
+
+def build_query(question: str, images: list[str]) -> list[dict[str, str]]:
+    """Jina inputs for a question and its images, already run through prepare_query_images."""
     query = []
     query.append({ 'text': question })
-    if image is not None:
-        if isinstance(image, str):
-            query.append({ 'image': image })
-        if isinstance(image, list):
-            query.extend({'image': x } for x in image)
-    embeddings = get_embeddings(query)
-    vector = None
+    query.extend({'image': x } for x in images)
+    return query
+
+
+def combine_embeddings(embeddings: list[dict]) -> list[float] | None:
     if len(embeddings) == 0:
-        return { 'answer': '', 'links': [] }
+        return None
     elif len(embeddings) == 1:
-        vector = embeddings[0]['embedding']
-    else:
-        vector = np.array(embeddings[0]['embedding'])
-        for emb in embeddings[1:]:
-            vector += np.array(emb['embedding'])
-        vector /= len(embeddings)
-        vector = vector.tolist()
-    # print(vector)
-    # exit()
-    context = get_context(vector)
-    links = [{ 'url': x['metadata']['url'], 'text': x['metadata']['content'] } for x in context['matches']]
-    prompt = get_prompt("\n\n".join(x['metadata']['content'] for x in context['matches']), question)
-    response = llm_client.models.generate_content(
-        model=GEMINI_MODEL_NAME, contents=[prompt]
-    )
-    return { 'answer': response.text, 'links': links }
+        return embeddings[0]['embedding']
+    vector = np.mean([emb['embedding'] for emb in embeddings], axis=0)
+    return vector.tolist()
+
+
+def get_links(context) -> list[dict[str, str]]:
+    return [{ 'url': x['metadata']['url'], 'text': x['metadata']['content'] } for x in context['matches']]
+
+
+def build_prompt(context, question: str) -> str:
+    return get_prompt(pack_context(context['matches']), question)
+
+
+def record_prompt_tokens(response, prompt: str):
+    # Gemini reports the real count; fall back to the packing estimate
+    usage = getattr(response, "usage_metadata", None)
+    tokens = getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt)
+    prompt_tokens.observe(tokens)
+
+
+def get_llm_response(question: str, image: str | list[str] | None=None):
+    with stage("images"):
+        images = prepare_query_images(image, EMBEDDING_BACKEND == "onnx")
+    with stage("embed"):
+        embeddings = get_embeddings(build_query(question, images))
+    vector = combine_embeddings(embeddings)
+    if vector is None:
+        return { 'answer': '', 'links': [] }
+    generation = index_generation() if answer_cache is not None else None
+    if answer_cache is not None and (cached := answer_cache.get(vector, generation)) is not None:
+        return cached
+    with stage("retrieve"):
+        context = retrieve(embeddings, vector)
+    with stage("prompt"):
+        prompt = build_prompt(context, question)
+    with stage("generate"):
+        response = get_llm_client().models.generate_content(
+            model=GEMINI_MODEL_NAME, contents=[prompt]
+        )
+    record_prompt_tokens(response, prompt)
+    result = { 'answer': response.text, 'links': get_links(context) }
+    if answer_cache is not None:
+        answer_cache.set(vector, result, generation)
+    return result
+
+
+def query_key(question: str, image: str | list[str] | None) -> str:
+    """Normalized question plus a hash of each image as sent, before any preprocessing."""
+    images = [image] if isinstance(image, str) else list(image or [])
+    parts = [normalize_text(question)] + [hashlib.sha256(x.encode()).hexdigest() for x in images]
+    return "\n".join(parts)
+
+
+async def aget_llm_response(question: str, image: str | list[str] | None=None):
+    """
+    Answers a query. Identical queries that arrive while one is already being
+    answered wait for that answer instead of running the pipeline again.
+    """
+    if not QUERY_COALESCING_ENABLED:
+        return await agenerate_llm_response(question, image)
+    key = query_key(question, image)
+    if key in query_flights:
+        coalesced_queries.inc()
+    return await query_flights.do(key, lambda: agenerate_llm_response(question, image))
+
+
+def degraded_reason(error: Exception) -> str:
+    """Label for degraded_answers, from a fixed set so the metric stays bounded."""
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    return "error"
+
+
+def retrieval_only_response(context, reason: str) -> dict:
+    degraded_answers.inc(reason=reason)
+    return { 'answer': FALLBACK_ANSWER, 'links': get_links(context), 'degraded': True }
+
+
+async def agenerate_llm_response(question: str, image: str | list[str] | None=None):
+    current_deadline.set(Deadline(QUERY_DEADLINE_SECONDS))
+    with stage("images"):
+        images = await asyncio.to_thread(prepare_query_images, image, EMBEDDING_BACKEND == "onnx")
+    with stage("embed"):
+        embeddings = await within_deadline(
+            aget_embeddings(build_query(question, images)), "embed", EMBED_TIMEOUT
+        )
+    vector = combine_embeddings(embeddings)
+    if vector is None:
+        return { 'answer': '', 'links': [] }
+    # The stamp only matters to the answer cache, so skip the fetch without one
+    generation = await aindex_generation() if answer_cache is not None else None
+    if answer_cache is not None and (cached := answer_cache.get(vector, generation)) is not None:
+        return cached
+    with stage("retrieve"):
+        context = await within_deadline(aretrieve(embeddings, vector), "retrieve", RETRIEVE_TIMEOUT)
+    with stage("prompt"):
+        prompt = build_prompt(context, question)
+    try:
+        async with gemini_breaker.attempt():
+            with stage("generate"):
+                response = await within_deadline(
+                    get_llm_client().aio.models.generate_content(
+                        model=GEMINI_MODEL_NAME, contents=[prompt]
+                    ),
+                    "generate",
+                    GENERATE_TIMEOUT,
+                )
+    except CircuitOpenError:
+        return retrieval_only_response(context, "breaker_open")
+    except Exception as e:
+        print(f"Generation failed, answering with links only: {e!r}")
+        return retrieval_only_response(context, degraded_reason(e))
+    record_prompt_tokens(response, prompt)
+    result = { 'answer': response.text, 'links': get_links(context) }
+    if answer_cache is not None:
+        answer_cache.set(vector, result, generation)
+    return result
+
+
+async def astream_llm_response(question: str, image: str | list[str] | None=None):
+    """
+    Streaming variant of aget_llm_response. Yields (event, data) pairs:
+    ("links", links) as soon as retrieval returns, then ("token", text) for
+    every chunk Gemini streams back, then ("done", None). While the Gemini
+    circuit breaker is open, ("degraded", message) replaces the tokens.
+    """
+    current_deadline.set(Deadline(QUERY_DEADLINE_SECONDS))
+    with stage("images"):
+        images = await asyncio.to_thread(prepare_query_images, image, EMBEDDING_BACKEND == "onnx")
+    with stage("embed"):
+        embeddings = await within_deadline(
+            aget_embeddings(build_query(question, images)), "embed", EMBED_TIMEOUT
+        )
+    vector = combine_embeddings(embeddings)
+    if vector is None:
+        yield "links", []
+        yield "done", None
+        return
+    generation = await aindex_generation() if answer_cache is not None else None
+    if answer_cache is not None and (cached := answer_cache.get(vector, generation)) is not None:
+        yield "links", cached['links']
+        yield "token", cached['answer']
+        yield "done", None
+        return
+    with stage("retrieve"):
+        context = await within_deadline(aretrieve(embeddings, vector), "retrieve", RETRIEVE_TIMEOUT)
+    links = get_links(context)
+    yield "links", links
+    with stage("prompt"):
+        prompt = build_prompt(context, question)
+    answer = []
+    chunk = None
+    try:
+        # A client disconnecting mid-stream closes this generator, which
+        # frees the breaker's trial slot without counting as a failure
+        async with gemini_breaker.attempt():
+            # Timed until the last chunk, so this includes time the client takes to read
+            with stage("generate"):
+                stream = await within_deadline(
+                    get_llm_client().aio.models.generate_content_stream(
+                        model=GEMINI_MODEL_NAME, contents=[prompt]
+                    ),
+                    "generate",
+                    GENERATE_TIMEOUT,
+                )
+                # Every chunk has to arrive within what is left of the deadline
+                while True:
+                    try:
+                        chunk = await within_deadline(anext(stream), "generate", GENERATE_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    if chunk.text:
+                        answer.append(chunk.text)
+                        yield "token", chunk.text
+    except CircuitOpenError:
+        degraded_answers.inc(reason="breaker_open")
+        yield "degraded", FALLBACK_ANSWER
+        yield "done", None
+        return
+    record_prompt_tokens(chunk, prompt)
+    if answer_cache is not None:
+        answer_cache.set(vector, { 'answer': "".join(answer), 'links': links }, generation)
+    yield "done", None
 
 
 if __name__ == "__main__":
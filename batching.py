@@ -0,0 +1,92 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class EmbeddingBatcher:
+    """
+    Collects embedding inputs from concurrent callers and sends them upstream
+    as one multi-input request.
+
+    A batch is flushed once it holds `max_batch_size` inputs or `max_wait`
+    seconds after its first input arrived, whichever comes first. Identical
+    inputs (by `key`) within a batch are sent once. Each caller gets back the
+    embeddings for its own inputs, in order; an upstream error is raised in
+    every caller of that batch.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[list[dict]], Awaitable[list[dict]]],
+        max_batch_size: int = 32,
+        max_wait: float = 0.01,
+        key: Callable[[dict], str] = repr,
+    ):
+        self.fetch = fetch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.key = key
+        self._pending: list[tuple[list[dict], asyncio.Future]] = []
+        self._pending_size = 0
+        self._timer: asyncio.TimerHandle | None = None
+        # The loop only keeps weak references to tasks, so in-flight sends are held here
+        self._tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.inputs = 0
+
+    async def submit(self, inputs: list[dict]) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((inputs, future))
+        self._pending_size += len(inputs)
+        if self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_size = self._pending, [], 0
+        if pending:
+            task = asyncio.ensure_future(self._send(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Sends whatever is still waiting and waits for every in-flight batch."""
+        self._flush()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _send(self, pending: list[tuple[list[dict], asyncio.Future]]):
+        unique: dict[str, int] = {}
+        batch = []
+        for inputs, _ in pending:
+            for item in inputs:
+                key = self.key(item)
+                if key not in unique:
+                    unique[key] = len(batch)
+                    batch.append(item)
+        self.batches += 1
+        self.inputs += len(batch)
+        try:
+            data = await self.fetch(batch)
+            embeddings = [x["embedding"] for x in sorted(data, key=lambda x: x.get("index", 0))]
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except asyncio.CancelledError:
+            for _, future in pending:
+                future.cancel()
+            raise
+        for inputs, future in pending:
+            if not future.done():
+                future.set_result(
+                    [
+                        {"index": i, "embedding": embeddings[unique[self.key(item)]]}
+                        for i, item in enumerate(inputs)
+                    ]
+                )
@@ -0,0 +1,95 @@
+"""
+Micro-benchmarks for build_reply_hierarchy and create_hierarchical_chunks on
+generated reply trees of varying depth.
+
+    python benchmarks/chunking.py [--depths 1 4 16 64] [--posts 400] [--repeat 5]
+
+Each tree has --posts posts arranged as chains of the given depth, so deeper
+trees carry more parent context per chunk. The token count cache is cleared
+before every run so each one pays for tokenization, as a fresh ingestion
+would. "pre-pass texts" is how many strings pretokenize_threads tokenized
+and "hits" how many of the chunker's token counts they answered. Needs the
+jina-clip-v2 tokenizer in the local Hugging Face cache.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = "the exam project deadline docker python pandas regression marks portal submit error".split()
+
+
+def generate_topic(topic_id: int, posts: int, depth: int, words: int, rng: random.Random) -> list[dict]:
+    """A flat topic in crawl format: every post replies to the one above it, restarting each `depth` posts."""
+    flat = []
+    for n in range(1, posts + 1):
+        position = (n - 1) % depth
+        flat.append(
+            {
+                "id": topic_id * 100000 + n,
+                "post_number": n,
+                "reply_to_post_number": n - 1 if position else None,
+                "raw": " ".join(rng.choices(WORDS, k=words)),
+                "title": f"Benchmark topic {topic_id}",
+                "topic_id": topic_id,
+                "url": f"https://discourse.example/t/{topic_id}/{n}",
+            }
+        )
+    return flat
+
+
+def timed(fn, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--posts", type=int, default=400)
+    parser.add_argument("--words", type=int, default=80, help="words per post")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from utils import build_reply_hierarchy, create_hierarchical_chunks, pretokenize_threads, token_count_cache
+
+    print(
+        f"{'depth':>6}{'posts':>7}{'chunks':>8}{'pre-pass texts':>16}{'hits':>8}"
+        f"{'hierarchy ms':>14}{'chunks ms':>12}{'posts/s':>10}"
+    )
+    for depth in args.depths:
+        flat = generate_topic(1, args.posts, depth, args.words, random.Random(args.seed))
+
+        hierarchy_ms = timed(lambda: build_reply_hierarchy(flat), args.repeat)
+        tree = build_reply_hierarchy(flat)
+
+        chunks, texts, hits = [], [0], [0]
+
+        def chunk():
+            if token_count_cache is not None:
+                token_count_cache.clear()
+            texts[0] = pretokenize_threads(tree)["texts"]
+            before = token_count_cache.hits if token_count_cache is not None else 0
+            chunks[:] = create_hierarchical_chunks(tree, pretokenize=False)
+            if token_count_cache is not None:
+                # Lookups the chunker answered from the pre-pass
+                hits[0] = token_count_cache.hits - before
+
+        chunk_ms = timed(chunk, args.repeat)
+        hierarchy = statistics.median(hierarchy_ms)
+        median = statistics.median(chunk_ms)
+        print(
+            f"{depth:>6}{args.posts:>7}{len(chunks):>8}{texts[0]:>16}{hits[0]:>8}{hierarchy:>14.2f}"
+            f"{median:>12.1f}{args.posts / (median / 1000):>10.0f}"
+        )
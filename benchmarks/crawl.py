@@ -0,0 +1,142 @@
+"""
+Offline crawler check: runs DiscourseCrawler against a fake Discourse
+category through an in-process ASGI transport and checks what it writes.
+
+    python benchmarks/crawl.py [--topics 70] [--posts 120]
+
+Covers paginated topic lists, posts fetched in batches of ids, retries on
+429 and 5xx, conditional requests answered with 304, and the crawl state
+only advancing once commit_crawl_state confirms the output was ingested.
+Exits non-zero when a check fails.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from extract_discourse import POST_IDS_PER_REQUEST, DiscourseCrawler, commit_crawl_state  # noqa: E402
+from fake_services import FakeDiscourse  # noqa: E402
+from generate_embeddings import live_topics, read_topics  # noqa: E402
+
+failures = []
+
+
+def check(condition: bool, message: str):
+    print(f"{'ok' if condition else 'FAIL':>4}  {message}")
+    if not condition:
+        failures.append(message)
+
+
+async def crawl(fake: FakeDiscourse, output_path: str) -> dict:
+    crawler = DiscourseCrawler(
+        "http://discourse.test",
+        fake.category_id,
+        output_path,
+        rate_limit=0,
+        transport=httpx.ASGITransport(app=fake.make_app()),
+    )
+    try:
+        return await crawler.crawl()
+    finally:
+        await crawler.close()
+
+
+def read_output(output_path: str) -> tuple[dict[int, dict], set[int]]:
+    topics, unchanged = {}, set()
+    for topic in read_topics(output_path):
+        if topic.get("unchanged"):
+            unchanged.add(topic["id"])
+        else:
+            topics[topic["id"]] = topic
+    return topics, unchanged
+
+
+async def run(args):
+    fake = FakeDiscourse()
+    for topic_id in range(1, args.topics + 1):
+        fake.add_topic(topic_id, args.posts if topic_id == 1 else 3)
+    all_ids = set(fake.topics)
+    fake.faults = {
+        f"/c/{fake.category_id}.json": [429],
+        "/t/2.json": [503, 502],
+        "/t/1/posts.json": [500],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = os.path.join(tmp, "topics.jsonl")
+
+        print("First crawl")
+        start = time.perf_counter()
+        stats = await crawl(fake, output_path)
+        topics, unchanged = read_output(output_path)
+        check(set(topics) == all_ids, f"all {len(all_ids)} topics across list pages written")
+        check(not unchanged, "no unchanged markers without crawl state")
+        check(
+            [p["post_number"] for p in topics[1]["posts"]] == list(range(1, args.posts + 1)),
+            f"topic 1 has all {args.posts} posts in order",
+        )
+        batches = [path for path, status in fake.requests if path == "/t/1/posts.json" and status == 200]
+        expected = -(-args.posts // POST_IDS_PER_REQUEST)
+        check(len(batches) == expected, f"topic 1 posts fetched in {expected} batches of ids")
+        check(not any(fake.faults.values()), "every injected 429/5xx was retried")
+        check(stats["failed"] == 0, "no topic failed")
+        print(f"      {stats} in {time.perf_counter() - start:.1f}s")
+
+        print("Second crawl, output not ingested yet")
+        stats = await crawl(fake, output_path)
+        topics, unchanged = read_output(output_path)
+        check(set(topics) == all_ids, "uncommitted topics are fetched and written again")
+
+        print("Third crawl, after commit")
+        check(commit_crawl_state(output_path), "crawl state committed")
+        fake.requests.clear()
+        stats = await crawl(fake, output_path)
+        topics, unchanged = read_output(output_path)
+        not_modified = sum(1 for path, status in fake.requests if status == 304)
+        check(not topics and unchanged == all_ids, "every topic written as an unchanged marker")
+        check(not_modified == len(all_ids), "every topic request answered with 304")
+        check(
+            not any(path.endswith("/posts.json") for path, _ in fake.requests),
+            "no posts fetched for unchanged topics",
+        )
+        commit_crawl_state(output_path)
+
+        print("Fourth crawl, one topic edited and one deleted")
+        fake.add_post(3)
+        del fake.topics[4]
+        stats = await crawl(fake, output_path)
+        topics, unchanged = read_output(output_path)
+        check(set(topics) == {3} and len(topics[3]["posts"]) == 4, "only the edited topic is written")
+        seen: set[str] = set()
+        list(live_topics(read_topics(output_path), seen))
+        check(
+            seen == {str(i) for i in all_ids - {4}},
+            "ingestion sees every live topic, so only the deleted one can be pruned",
+        )
+
+        print("Fifth crawl, previous output lost before ingestion")
+        os.remove(output_path)
+        stats = await crawl(fake, output_path)
+        topics, _ = read_output(output_path)
+        check(set(topics) == {3}, "the edit is fetched again since it was never committed")
+
+    if failures:
+        print(f"\n{len(failures)} checks failed")
+        sys.exit(1)
+    print("\nAll checks passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--topics", type=int, default=70, help="more than two list pages of 30")
+    parser.add_argument("--posts", type=int, default=120, help="posts in topic 1")
+    asyncio.run(run(parser.parse_args()))
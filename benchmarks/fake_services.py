@@ -0,0 +1,279 @@
+"""
+Local stand-ins for the Jina embeddings, Pinecone query and Gemini
+generation APIs, so the query path can be load-tested without any network,
+and for the Discourse endpoints the crawler uses.
+
+Each service answers with the same response shape as the real API after a
+configurable latency plus uniform jitter. Embeddings are deterministic per
+input, and the fake index returns a fixed synthetic corpus.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class Latency:
+    """Base delay plus up to `jitter` extra, both in milliseconds."""
+
+    base_ms: float = 0.0
+    jitter_ms: float = 0.0
+
+    async def sleep(self):
+        delay = self.base_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+
+def fake_embedding(item: dict, dimensions: int) -> list[float]:
+    seed = int(hashlib.sha256(json.dumps(item, sort_keys=True).encode()).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).normal(size=dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def make_jina_app(latency: Latency, dimensions: int = 1024) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/{path:path}")
+    async def embeddings(request: Request):
+        body = await request.json()
+        await latency.sleep()
+        dims = int(body.get("dimensions") or dimensions)
+        return {
+            "model": body.get("model"),
+            "object": "list",
+            "usage": {"total_tokens": 0, "prompt_tokens": 0},
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(item, dims)}
+                for i, item in enumerate(body["input"])
+            ],
+        }
+
+    return app
+
+
+def fake_corpus(size: int = 200, topics: int = 40) -> list[dict]:
+    rng = random.Random(0)
+    words = "exam deadline project docker python pandas regression grading portal assignment".split()
+    return [
+        {
+            "id": f"{1000 + i}-chunk-0",
+            "metadata": {
+                "chunked_id": f"{1000 + i}-chunk-0",
+                "topic_id": i % topics,
+                "post_id": 1000 + i,
+                "chunk_index": 0,
+                "content": f"Post {1000 + i}: " + " ".join(rng.choices(words, k=120)),
+                "url": f"https://discourse.example/t/{i % topics}/{i}",
+            },
+        }
+        for i in range(size)
+    ]
+
+
+def make_pinecone_app(latency: Latency, corpus: list[dict] | None = None) -> FastAPI:
+    app = FastAPI()
+    corpus = corpus or fake_corpus()
+
+    @app.post("/query")
+    async def query(request: Request):
+        body = await request.json()
+        await latency.sleep()
+        top_k = int(body.get("topK", 10))
+        # Stable per vector so repeated questions see the same context
+        seed = int(abs(sum(body.get("vector", [])[:8])) * 1e6)
+        matches = random.Random(seed).sample(corpus, min(top_k, len(corpus)))
+        return {
+            "namespace": body.get("namespace", ""),
+            "matches": [
+                {"id": m["id"], "score": 1.0 - i / 100, "values": [], "metadata": m["metadata"]}
+                for i, m in enumerate(matches)
+            ],
+            "usage": {"readUnits": 1},
+        }
+
+    @app.get("/vectors/fetch")
+    async def fetch(request: Request):
+        # No index generation stamp, as for an index nothing has stamped yet
+        await latency.sleep()
+        return {"namespace": request.query_params.get("namespace", ""), "vectors": {}, "usage": {"readUnits": 1}}
+
+    return app
+
+
+def gemini_response(text: str, prompt_tokens: int) -> dict:
+    return {
+        "candidates": [
+            {"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP", "index": 0}
+        ],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": len(text.split()),
+            "totalTokenCount": prompt_tokens + len(text.split()),
+        },
+    }
+
+
+def make_gemini_app(latency: Latency, answer_tokens: int = 60, stream_chunks: int = 6) -> FastAPI:
+    app = FastAPI()
+    answer = " ".join(["The answer is in the linked posts."] * (answer_tokens // 7 + 1))
+
+    def prompt_size(body: dict) -> int:
+        text = "".join(
+            part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])
+        )
+        return len(text) // 4
+
+    @app.post("/{version}/models/{model}:generateContent")
+    async def generate(version: str, model: str, request: Request):
+        body = await request.json()
+        await latency.sleep()
+        return gemini_response(answer, prompt_size(body))
+
+    @app.post("/{version}/models/{model}:streamGenerateContent")
+    async def stream(version: str, model: str, request: Request):
+        body = await request.json()
+        size = len(answer) // stream_chunks + 1
+        parts = [answer[i : i + size] for i in range(0, len(answer), size)]
+
+        async def events():
+            # The configured latency is spread over the chunks, first token included
+            for part in parts:
+                await asyncio.sleep((latency.base_ms + random.uniform(0, latency.jitter_ms)) / 1000 / len(parts))
+                yield f"data: {json.dumps(gemini_response(part, prompt_size(body)))}\r\n\r\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+class FakeDiscourse:
+    """
+    In-memory Discourse category: paginated topic lists, topics with an ETag
+    that changes with their posts, and posts fetched by id.
+
+    `faults` maps a request path to status codes returned, in order, before
+    it is served normally (e.g. {"/c/34.json": [429]}). Every request is
+    logged as (path, status).
+    """
+
+    def __init__(self, category_id: str = "34", per_page: int = 30):
+        self.category_id = category_id
+        self.per_page = per_page
+        self.topics: dict[int, dict] = {}
+        self.faults: dict[str, list[int]] = {}
+        self.requests: list[tuple[str, int]] = []
+
+    def add_topic(self, topic_id: int, posts: int, replies: bool = True):
+        self.topics[topic_id] = {"id": topic_id, "title": f"Topic {topic_id}", "posts": []}
+        for _ in range(posts):
+            self.add_post(topic_id, replies)
+
+    def add_post(self, topic_id: int, replies: bool = True):
+        posts = self.topics[topic_id]["posts"]
+        number = len(posts) + 1
+        posts.append(
+            {
+                "id": topic_id * 10000 + number,
+                "post_number": number,
+                # Every third post answers an earlier one, to give the chunker a tree
+                "reply_to_post_number": number // 2 if replies and number > 1 and number % 3 == 0 else None,
+                "username": f"user{number % 7}",
+                "created_at": "2025-01-01T00:00:00Z",
+                "raw": f"Post {number} of topic {topic_id}",
+            }
+        )
+
+    def etag(self, topic_id: int) -> str:
+        return f'"{topic_id}-{len(self.topics[topic_id]["posts"])}"'
+
+    def make_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.middleware("http")
+        async def inject_faults(request: Request, call_next):
+            queued = self.faults.get(request.url.path)
+            if queued:
+                status = queued.pop(0)
+                self.requests.append((request.url.path, status))
+                return Response(status_code=status, headers={"Retry-After": "0"})
+            response = await call_next(request)
+            self.requests.append((request.url.path, response.status_code))
+            return response
+
+        @app.get("/c/{category_id}.json")
+        async def topic_list(category_id: str, page: int = 0):
+            ordered = sorted(self.topics)
+            start = page * self.per_page
+            ids = ordered[start : start + self.per_page] if category_id == self.category_id else []
+            more = start + self.per_page < len(ordered)
+            return {
+                "topic_list": {
+                    "topics": [{"id": i, "title": self.topics[i]["title"]} for i in ids],
+                    "more_topics_url": f"/c/{category_id}?page={page + 1}" if more else None,
+                }
+            }
+
+        @app.get("/t/{topic_id}.json")
+        async def topic(topic_id: int, request: Request):
+            if topic_id not in self.topics:
+                return JSONResponse({"errors": ["not found"]}, status_code=404)
+            etag = self.etag(topic_id)
+            if request.headers.get("If-None-Match") == etag:
+                return Response(status_code=304, headers={"ETag": etag})
+            data = self.topics[topic_id]
+            return JSONResponse(
+                {
+                    "id": topic_id,
+                    "title": data["title"],
+                    "slug": f"topic-{topic_id}",
+                    "created_at": "2025-01-01T00:00:00Z",
+                    # Like Discourse, only the first posts are inlined; the stream lists them all
+                    "post_stream": {
+                        "posts": data["posts"][:20],
+                        "stream": [post["id"] for post in data["posts"]],
+                    },
+                },
+                headers={"ETag": etag},
+            )
+
+        @app.get("/t/{topic_id}/posts.json")
+        async def posts(topic_id: int, request: Request):
+            wanted = {int(x) for x in request.query_params.getlist("post_ids[]")}
+            found = [post for post in self.topics[topic_id]["posts"] if post["id"] in wanted]
+            return {"post_stream": {"posts": found}}
+
+        return app
+
+
+class ServerThread:
+    """Runs an ASGI app with uvicorn on a background thread."""
+
+    def __init__(self, app, port: int, host: str = "127.0.0.1"):
+        self.url = f"http://{host}:{port}"
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="on")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout: float = 10.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server on {self.url} did not start")
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
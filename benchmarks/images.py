@@ -0,0 +1,96 @@
+"""
+Offline query image check: runs prepare_query_images on generated images
+and checks what it accepts, shrinks and rejects.
+
+    python benchmarks/images.py
+
+Covers downscaling and re-encoding, duplicates, the encoded size limit, and
+a decompression bomb: a PNG of a few KB declaring ~178M pixels, which has to
+be rejected from its header in well under a second. Exits non-zero when a
+check fails.
+"""
+
+import base64
+import io
+import os
+import struct
+import sys
+import time
+import zlib
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from query_images import (  # noqa: E402
+    QUERY_IMAGE_MAX_BYTES,
+    QUERY_IMAGE_SIZE,
+    ImageTooLargeError,
+    InvalidImageError,
+    prepare_query_images,
+)
+
+failures = []
+
+
+def check(condition: bool, message: str):
+    print(f"{'ok' if condition else 'FAIL':>4}  {message}")
+    if not condition:
+        failures.append(message)
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def bomb_png(width: int, height: int) -> bytes:
+    """A valid all-black 1-bit PNG; its rows are zeros, so it compresses to almost nothing."""
+    row = b"\0" * (1 + (width + 7) // 8)
+    compressor = zlib.compressobj(9)
+    idat = b"".join(compressor.compress(row) for _ in range(height)) + compressor.flush()
+    header = struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", header) + png_chunk(b"IDAT", idat) + png_chunk(b"IEND", b"")
+
+
+def encode(img: Image.Image, fmt: str = "PNG") -> str:
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def raises(error: type, image) -> bool:
+    try:
+        prepare_query_images(image)
+    except error:
+        return True
+    return False
+
+
+def main():
+    photo = encode(Image.linear_gradient("L").resize((2000, 1500)).convert("RGB"))
+    prepared = prepare_query_images([photo, photo])
+    check(len(prepared) == 1, "duplicate images are sent once")
+    shrunk = Image.open(io.BytesIO(base64.b64decode(prepared[0])))
+    check(max(shrunk.size) == QUERY_IMAGE_SIZE, f"large image downscaled to {QUERY_IMAGE_SIZE}px")
+
+    check(raises(InvalidImageError, base64.b64encode(b"not an image").decode()), "non-image rejected")
+    oversized = "A" * (QUERY_IMAGE_MAX_BYTES * 4 // 3 + 4)
+    check(raises(ImageTooLargeError, oversized), "image over the byte limit rejected")
+
+    bomb = bomb_png(20000, 8900)
+    print(f"      bomb: {len(bomb) / 1024:.0f} KB declaring {20000 * 8900 / 1e6:.0f}M pixels")
+    start = time.perf_counter()
+    rejected = raises(ImageTooLargeError, base64.b64encode(bomb).decode())
+    elapsed = time.perf_counter() - start
+    check(rejected, "decompression bomb rejected as too large")
+    check(elapsed < 0.5, f"bomb rejected without decoding it ({elapsed * 1000:.0f} ms)")
+
+    if failures:
+        print(f"\n{len(failures)} checks failed")
+        sys.exit(1)
+    print("\nAll checks passed")
+
+
+if __name__ == "__main__":
+    main()
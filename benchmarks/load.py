@@ -0,0 +1,238 @@
+"""
+Offline load test: runs the FastAPI app against local fake Jina, Pinecone
+and Gemini servers and reports throughput and per-stage latency percentiles.
+
+    python benchmarks/load.py [--concurrency 16] [--requests 200] [--stream]
+        [--replay requests.jsonl] [--image-ratio 0.2]
+        [--jina-ms 40 --pinecone-ms 30 --gemini-ms 800 --jitter 0.5]
+
+Questions are replayed from a JSONL file (a "question" field, or "title" as
+a fallback, plus an optional "image") and topped up with synthetic
+questions, a share of which carry a generated image. Stage timings come
+from each response's Server-Timing header, so they match what the server
+measured; "client" is the latency seen by the load generator. With --stream
+the headers leave before generation, so look at "client" and "first_byte".
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import (  # noqa: E402
+    Latency,
+    ServerThread,
+    make_gemini_app,
+    make_jina_app,
+    make_pinecone_app,
+)
+
+SYNTHETIC_TOPICS = [
+    "the end-term exam date",
+    "the project 1 deadline",
+    "docker vs podman for the assignment",
+    "how GA marks are computed",
+    "the bonus marks policy",
+    "running the evaluation script locally",
+    "pandas merge errors in week 3",
+    "the Jan 2025 TDS schedule",
+]
+SYNTHETIC_TEMPLATES = [
+    "When is {}?",
+    "Can someone explain {}?",
+    "I have a doubt about {}, what should I do?",
+    "Is there an update on {}?",
+]
+
+
+def synthetic_image(rng: random.Random) -> str:
+    from PIL import Image
+
+    size = rng.choice([(320, 240), (800, 600), (1600, 900)])
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def load_replay(path: str) -> list[dict]:
+    payloads = []
+    if not path or not os.path.exists(path):
+        return payloads
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            question = row.get("question") or row.get("title")
+            if not question:
+                continue
+            payload = {"question": question}
+            if row.get("image"):
+                payload["image"] = row["image"]
+            payloads.append(payload)
+    return payloads
+
+
+def build_workload(args) -> list[dict]:
+    rng = random.Random(args.seed)
+    replay = load_replay(args.replay)
+    images = [synthetic_image(rng) for _ in range(4)]
+    workload = []
+    for i in range(args.requests):
+        if replay and i % 2 == 0:
+            payload = dict(replay[(i // 2) % len(replay)])
+        else:
+            template = rng.choice(SYNTHETIC_TEMPLATES)
+            payload = {"question": template.format(rng.choice(SYNTHETIC_TOPICS))}
+            if rng.random() < args.image_ratio:
+                payload["image"] = rng.choice(images)
+        workload.append(payload)
+    return workload
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    timings = {}
+    for entry in filter(None, (x.strip() for x in header.split(","))):
+        name, _, params = entry.partition(";")
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                timings[name.strip()] = float(value)
+    return timings
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def configure_environment(args, jina_url: str, pinecone_url: str, gemini_url: str):
+    # Must run before app_utils is imported; real keys in .env are never used
+    os.environ.update(
+        {
+            "JINA_API_ENDPOINT": f"{jina_url}/v1/embeddings",
+            "JINA_API_KEY": "benchmark",
+            "JINA_EMBEDDING_MODEL_NAME": "jina-clip-v2",
+            "JINA_EMBEDDING_MODEL_DIMENSIONS": str(args.dimensions),
+            "EMBEDDING_BACKEND": "jina",
+            "PINECONE_API_KEY": "benchmark",
+            "PINECONE_INDEX_NAME": "benchmark",
+            "PINECONE_NAMESPACE": "benchmark",
+            "PINECONE_HOST": pinecone_url,
+            "VECTOR_BACKEND": "pinecone",
+            "GEMINI_API_KEY": "benchmark",
+            "GEMINI_MODEL_NAME": "gemini-benchmark",
+            "GOOGLE_GEMINI_BASE_URL": gemini_url,
+            "EMBEDDING_CACHE_BACKEND": "memory" if args.caches else "none",
+            "ANSWER_CACHE_ENABLED": "true" if args.caches else "false",
+        }
+    )
+
+
+async def run_load(base_url: str, workload: list[dict], concurrency: int, stream: bool):
+    import httpx
+
+    path = "/api/v1/query/stream" if stream else "/api/v1/query"
+    queue: asyncio.Queue = asyncio.Queue()
+    for payload in workload:
+        queue.put_nowait(payload)
+    results = []
+
+    async def worker(client: httpx.AsyncClient):
+        while not queue.empty():
+            payload = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                async with client.stream("POST", path, json=payload) as response:
+                    first_byte = None
+                    async for _ in response.aiter_bytes():
+                        if first_byte is None:
+                            first_byte = time.perf_counter() - start
+                    timings = parse_server_timing(response.headers.get("server-timing", ""))
+                    timings["client"] = (time.perf_counter() - start) * 1000
+                    if stream and first_byte is not None:
+                        timings["first_byte"] = first_byte * 1000
+                    results.append((response.status_code, timings))
+            except httpx.HTTPError as e:
+                results.append((type(e).__name__, {"client": (time.perf_counter() - start) * 1000}))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def report(results, elapsed: float):
+    statuses: dict = {}
+    stages: dict[str, list[float]] = {}
+    for status, timings in results:
+        statuses[status] = statuses.get(status, 0) + 1
+        for name, value in timings.items():
+            stages.setdefault(name, []).append(value)
+
+    print(f"\n{len(results)} requests in {elapsed:.2f}s, {len(results) / elapsed:.1f} req/s")
+    print("status: " + ", ".join(f"{k}={v}" for k, v in sorted(statuses.items(), key=str)))
+    print(f"\n{'stage':<12}{'n':>6}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for name, values in stages.items():
+        print(
+            f"{name:<12}{len(values):>6}{statistics.fmean(values):>10.1f}"
+            f"{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}{percentile(values, 99):>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--replay", default=os.path.join(ROOT, "requests.jsonl"))
+    parser.add_argument("--image-ratio", type=float, default=0.2)
+    parser.add_argument("--stream", action="store_true", help="use the SSE endpoint")
+    parser.add_argument("--caches", action="store_true", help="keep the embedding and answer caches on")
+    parser.add_argument("--jina-ms", type=float, default=40)
+    parser.add_argument("--pinecone-ms", type=float, default=30)
+    parser.add_argument("--gemini-ms", type=float, default=800)
+    parser.add_argument("--jitter", type=float, default=0.5, help="jitter as a fraction of each latency")
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--port", type=int, default=8700, help="first of four consecutive ports")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    def latency(ms: float) -> Latency:
+        return Latency(ms, ms * args.jitter)
+
+    services = [
+        ServerThread(make_jina_app(latency(args.jina_ms), args.dimensions), args.port).start(),
+        ServerThread(make_pinecone_app(latency(args.pinecone_ms)), args.port + 1).start(),
+        ServerThread(make_gemini_app(latency(args.gemini_ms)), args.port + 2).start(),
+    ]
+    configure_environment(args, *(s.url for s in services))
+
+    from app import app  # noqa: E402
+
+    server = ServerThread(app, args.port + 3).start()
+    workload = build_workload(args)
+    print(
+        f"{len(workload)} requests at concurrency {args.concurrency}; upstream latency "
+        f"jina={args.jina_ms}ms pinecone={args.pinecone_ms}ms gemini={args.gemini_ms}ms "
+        f"(+{args.jitter:.0%} jitter)"
+    )
+    try:
+        results, elapsed = asyncio.run(run_load(server.url, workload, args.concurrency, args.stream))
+        report(results, elapsed)
+    finally:
+        for s in [server, *services]:
+            s.stop()
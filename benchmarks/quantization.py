@@ -0,0 +1,94 @@
+"""
+Recall, memory and latency of quantized first-pass search with rescoring,
+against exact full-precision search.
+
+    python benchmarks/quantization.py [--index snapshot] [--queries 200]
+        [--dims 128 256 512] [--rescore 50 100 200]
+
+--index takes a snapshot directory or a saved .npz index; queries are then
+perturbed copies of random rows. Without it a synthetic corpus is generated
+whose variance decays across dimensions, as in a Matryoshka embedding, which
+gives indicative but not real-world recall numbers.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vector_store import LocalIndex, QuantizedIndex, load_local_index  # noqa: E402
+
+
+def synthetic_index(size: int, dimensions: int, clusters: int, seed: int) -> LocalIndex:
+    rng = np.random.default_rng(seed)
+    decay = 1 / np.sqrt(1 + np.arange(dimensions) / 64)
+    centers = rng.normal(size=(clusters, dimensions))
+    rows = centers[rng.integers(clusters, size=size)] + 0.8 * rng.normal(size=(size, dimensions))
+    embeddings = (rows * decay).astype(np.float32)
+    ids = [str(i) for i in range(size)]
+    return LocalIndex(ids, embeddings, [{} for _ in ids])
+
+
+def make_queries(index, count: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed + 1)
+    rows = np.asarray(index.embeddings[rng.integers(len(index), size=count)], dtype=np.float32)
+    return rows + 0.05 * rng.normal(size=rows.shape).astype(np.float32)
+
+
+def run(index, queries: np.ndarray, top_k: int):
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        indices, _ = index.search(query, top_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(indices)
+    return results, latencies
+
+
+def recall(results, truth) -> float:
+    return statistics.fmean(len(set(r) & set(t)) / len(t) for r, t in zip(results, truth))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--index", help="snapshot directory or .npz index")
+    parser.add_argument("--size", type=int, default=50000, help="synthetic corpus size")
+    parser.add_argument("--dimensions", type=int, default=1024, help="synthetic corpus dimensions")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dims", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--rescore", type=int, nargs="+", default=[50, 100, 200])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.index:
+        kind = "snapshot" if os.path.isdir(args.index) else "exact"
+        base = load_local_index(args.index, kind)
+    else:
+        base = synthetic_index(args.size, args.dimensions, max(1, args.size // 100), args.seed)
+    queries = make_queries(base, args.queries, args.seed)
+    truth, exact_ms = run(base, queries, args.top_k)
+    full_bytes = len(base) * base.embeddings.shape[1] * 4
+
+    print(f"{len(base)} vectors x {base.embeddings.shape[1]} dims, {args.queries} queries, recall@{args.top_k}")
+    print(f"{'mode':<8}{'dims':>6}{'rescore':>9}{'recall':>9}{'first-pass MB':>15}{'vs f32':>8}{'p50 ms':>9}{'p95 ms':>9}")
+    print(
+        f"{'float32':<8}{base.embeddings.shape[1]:>6}{'-':>9}{1.0:>9.3f}{full_bytes / 2**20:>15.1f}"
+        f"{1.0:>7.1f}x{statistics.median(exact_ms):>9.2f}{np.percentile(exact_ms, 95):>9.2f}"
+    )
+    for mode in ("int8", "binary"):
+        for dims in args.dims:
+            for rescore_k in args.rescore:
+                index = QuantizedIndex(base, mode, dims, rescore_k)
+                results, ms = run(index, queries, args.top_k)
+                print(
+                    f"{mode:<8}{index.truncate_dim:>6}{rescore_k:>9}{recall(results, truth):>9.3f}"
+                    f"{index.nbytes / 2**20:>15.2f}{full_bytes / index.nbytes:>7.1f}x"
+                    f"{statistics.median(ms):>9.2f}{np.percentile(ms, 95):>9.2f}"
+                )
@@ -0,0 +1,69 @@
+"""
+Cold start benchmark: imports the app in fresh interpreters and checks the
+median import time against a budget.
+
+    python benchmarks/startup.py [--runs 5] [--budget-ms 800] [--module app]
+
+Exits non-zero when the budget is exceeded. Set PYTHONPROFILEIMPORTTIME=1 or
+pass --verbose to print the slowest imports of the last run.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "800"))
+
+
+def measure_import(module: str) -> tuple[float, str]:
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; "
+        "print((time.perf_counter() - start) * 1000)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_log: str, count: int = 15) -> list[tuple[int, str]]:
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [x.strip() for x in line.removeprefix("import time:").split("|")]
+        rows.append((int(cumulative), name))
+    return sorted(rows, reverse=True)[:count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    timings = []
+    for _ in range(args.runs):
+        elapsed, log = measure_import(args.module)
+        timings.append(elapsed)
+
+    median = statistics.median(timings)
+    print(f"import {args.module}: median {median:.0f} ms, min {min(timings):.0f} ms, max {max(timings):.0f} ms")
+    if args.verbose or os.getenv("PYTHONPROFILEIMPORTTIME"):
+        for cumulative, name in slowest_imports(log):
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    if median > args.budget_ms:
+        print(f"Over budget: {median:.0f} ms > {args.budget_ms:.0f} ms")
+        sys.exit(1)
+    print(f"Within budget of {args.budget_ms:.0f} ms")
@@ -0,0 +1,308 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+import numpy as np
+
+
+class BaseCache:
+    """
+    Common hit/miss bookkeeping for the cache backends.
+
+    Backends implement `_get`, `_set`, `clear` and `__len__`, and may override
+    `_set_many` to store a batch at once; `get` returns None on a miss, so
+    None itself is never stored.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any):
+        if value is None:
+            return
+        with self._lock:
+            self._set(key, value)
+
+    def set_many(self, items: dict[str, Any]):
+        items = {key: value for key, value in items.items() if value is not None}
+        if items:
+            with self._lock:
+                self._set_many(items)
+
+    def _set_many(self, items: dict[str, Any]):
+        for key, value in items.items():
+            self._set(key, value)
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class LRUCache(BaseCache):
+    """In-process cache with LRU eviction and an optional TTL in seconds."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        super().__init__(maxsize, ttl)
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        created, value = item
+        if self._expired(created):
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _set(self, key, value):
+        self._data[key] = (time.time(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(BaseCache):
+    """
+    On-disk cache backed by SQLite so entries survive restarts.
+
+    Values must be JSON serializable. Eviction follows last access time. Hits
+    only record their access time in memory; the times are written with the
+    next `set`, and rows are evicted in batches once the table outgrows
+    `maxsize`, so neither reads nor writes scan the whole table. The database
+    is opened in WAL mode with a busy timeout, so several processes (e.g.
+    chunking workers) can share one file.
+    """
+
+    # Pending access times written in one go once this many have piled up
+    TOUCH_FLUSH_SIZE = 1000
+
+    def __init__(self, path: str, maxsize: int = 1024, ttl: float | None = None):
+        super().__init__(maxsize, ttl)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+        self._conn.commit()
+        self._touched: dict[str, float] = {}
+        # Upper bound on the row count; only recounted when it passes maxsize
+        self._size = len(self)
+        # Evict a tenth of the cache at a time rather than one row per insert
+        self._evict_batch = max(1, maxsize // 10)
+
+    def _get(self, key):
+        row = self._conn.execute(
+            "SELECT value, created FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, created = row
+        if self._expired(created):
+            self._touched.pop(key, None)
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+            return None
+        self._touched[key] = time.time()
+        if len(self._touched) >= self.TOUCH_FLUSH_SIZE:
+            self._flush_touched()
+            self._conn.commit()
+        return json.loads(value)
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE cache SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _evict(self):
+        self._flush_touched()
+        self._size = len(self)
+        excess = self._size - self.maxsize
+        if excess > 0:
+            excess += min(self._evict_batch, self.maxsize)
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                (excess,),
+            )
+            self._size = max(0, self._size - excess)
+
+    def _set(self, key, value):
+        self._set_many({key: value})
+
+    def _set_many(self, items):
+        now = time.time()
+        for key in items:
+            self._touched.pop(key, None)
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            [(key, json.dumps(value), now, now) for key, value in items.items()],
+        )
+        self._size += len(items)
+        if self._size > self.maxsize:
+            self._evict()
+        else:
+            self._flush_touched()
+        self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+            self._size = 0
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class SemanticCache:
+    """
+    Answer cache keyed by query vectors instead of exact strings.
+
+    A lookup returns the value stored for the most similar cached vector if its
+    cosine similarity is at least `threshold`. Entries live in a fixed-size
+    float32 matrix; when it is full the least recently used slot is reused.
+
+    Each entry records the `generation` it was stored under (e.g. a version
+    stamp of the index it was answered from). Lookups only match entries of
+    the generation they ask for, so answers from an older index go stale
+    without anyone having to clear the cache.
+    """
+
+    def __init__(self, maxsize: int = 512, threshold: float = 0.97, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors: np.ndarray | None = None
+        self._values: list[Any] = [None] * maxsize
+        self._generations: list[Any] = [None] * maxsize
+        self._created = np.zeros(maxsize)
+        self._accessed = np.zeros(maxsize)
+        self._valid = np.zeros(maxsize, dtype=bool)
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self):
+        if self.ttl is not None:
+            self._valid &= time.time() - self._created <= self.ttl
+
+    def _current(self, generation) -> np.ndarray:
+        same = np.fromiter((g == generation for g in self._generations), dtype=bool, count=self.maxsize)
+        return self._valid & same
+
+    def get(self, vector, generation: Any = None) -> Any | None:
+        with self._lock:
+            self._expire()
+            current = self._current(generation)
+            if self._vectors is None or not current.any():
+                self.misses += 1
+                return None
+            query = self._normalize(vector)
+            if query.shape[0] != self._vectors.shape[1]:
+                self.misses += 1
+                return None
+            scores = self._vectors @ query
+            scores[~current] = -np.inf
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[slot] = time.time()
+            return self._values[slot]
+
+    def set(self, vector, value: Any, generation: Any = None):
+        with self._lock:
+            query = self._normalize(vector)
+            if self._vectors is None or self._vectors.shape[1] != query.shape[0]:
+                self._vectors = np.zeros((self.maxsize, query.shape[0]), dtype=np.float32)
+                self._valid[:] = False
+            self._expire()
+            # Entries of other generations can never match again, so they are free too
+            free = np.flatnonzero(~self._current(generation))
+            slot = int(free[0]) if len(free) else int(np.argmin(self._accessed))
+            now = time.time()
+            self._vectors[slot] = query
+            self._values[slot] = value
+            self._generations[slot] = generation
+            self._created[slot] = now
+            self._accessed[slot] = now
+            self._valid[slot] = True
+
+    def clear(self):
+        with self._lock:
+            self._valid[:] = False
+            self._values = [None] * self.maxsize
+            self._generations = [None] * self.maxsize
+
+    def __len__(self):
+        return int(self._valid.sum())
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def make_cache(
+    backend: str, maxsize: int = 1024, ttl: float | None = None, path: str | None = None
+) -> BaseCache | None:
+    """
+    Builds a cache for the given backend name: "memory", "disk" or "none".
+    """
+    if backend == "memory":
+        return LRUCache(maxsize, ttl)
+    if backend == "disk":
+        return SQLiteCache(path or "cache.sqlite3", maxsize, ttl)
+    if backend == "none":
+        return None
+    raise ValueError(f"Unknown cache backend: {backend}")
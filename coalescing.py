@@ -0,0 +1,40 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution.
+
+    The first caller for a key starts the work as a task; callers arriving
+    while it runs await the same task and get the same result or exception.
+    Nothing is kept once the task finishes, so results are never stale. The
+    task is shielded, so one caller disconnecting does not cancel the work
+    for the others.
+    """
+
+    def __init__(self):
+        self._flights: dict[str, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    def __contains__(self, key: str):
+        return key in self._flights
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
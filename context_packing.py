@@ -0,0 +1,81 @@
+import os
+
+# Rough prompt budget; serving does not load a tokenizer, so tokens are estimated
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def trim_overlap(previous: str, segment: str, min_overlap: int = 32) -> str:
+    """
+    Removes the start of `segment` if it repeats the end of `previous`, as
+    happens between consecutive parts of a split monolith post.
+    """
+    probe = segment[:min_overlap]
+    if len(probe) < min_overlap:
+        return segment
+    start = previous.find(probe, max(0, len(previous) - len(segment)))
+    while start != -1:
+        overlap = len(previous) - start
+        if segment[:overlap] == previous[start:]:
+            return segment[overlap:].lstrip()
+        start = previous.find(probe, start + 1)
+    return segment
+
+
+def group_matches(matches) -> list[list[dict]]:
+    """
+    Groups matches by thread, ordered by each thread's best match. Within a
+    thread, matches are put back in post order so parents come first.
+    """
+    groups: dict[str, list] = {}
+    for i, match in enumerate(matches):
+        metadata = match["metadata"]
+        key = str(metadata.get("topic_id", f"match-{i}"))
+        groups.setdefault(key, []).append(match)
+    return [
+        sorted(
+            group,
+            key=lambda x: (x["metadata"].get("post_id", 0), x["metadata"].get("chunk_index", 0)),
+        )
+        for group in groups.values()
+    ]
+
+
+def pack_context(matches, token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Assembles retrieved matches into prompt context.
+
+    Hierarchical chunks repeat their parents' text, so matches from the same
+    thread are collapsed into one excerpt and every paragraph is kept only the
+    first time it appears. Threads are added best-first; paragraphs that no
+    longer fit in the token budget are skipped.
+    """
+    seen: set[str] = set()
+    excerpts: list[str] = []
+    used = 0
+
+    for group in group_matches(matches):
+        parts: list[str] = []
+        for match in group:
+            for segment in match["metadata"]["content"].split("\n\n"):
+                segment = segment.strip()
+                if parts:
+                    segment = trim_overlap(parts[-1], segment)
+                if not segment or segment in seen:
+                    continue
+                cost = estimate_tokens(segment)
+                if used + cost > token_budget:
+                    continue
+                seen.add(segment)
+                parts.append(segment)
+                used += cost
+        if parts:
+            excerpts.append("\n\n".join(parts))
+        if used >= token_budget:
+            break
+
+    return "\n\n---\n\n".join(excerpts)
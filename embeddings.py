@@ -1,58 +1,196 @@
-from transformers import AutoModel
+import asyncio
+import base64
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-# Initialize the model
-model = AutoModel.from_pretrained("jinaai/jina-clip-v2", trust_remote_code=True)
+import numpy as np
 
+MODEL_NAME = "jinaai/jina-clip-v2"
+# fp16 or int8 export of jina-clip-v2, e.g. model_fp16.onnx / model_quantized.onnx
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "model_fp16.onnx")
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))  # 0 lets ONNX Runtime decide
+ONNX_RUNNER_WORKERS = int(os.getenv("ONNX_RUNNER_WORKERS", "2"))
+ONNX_TEXT_BATCH_SIZE = int(os.getenv("ONNX_TEXT_BATCH_SIZE", "32"))
+ONNX_IMAGE_BATCH_SIZE = int(os.getenv("ONNX_IMAGE_BATCH_SIZE", "8"))
+ONNX_MAX_TEXT_TOKENS = int(os.getenv("ONNX_MAX_TEXT_TOKENS", "512"))
+IMAGE_SIZE = 512
+# Instructions jina-clip-v2 prepends to texts per task, as the Jina API does;
+# the model config's task_instructions take precedence when present
+TASK_INSTRUCTIONS = {"retrieval.query": "Represent the query for retrieving evidence documents: "}
 
-def generate_embeddings(inputs, input_type):
-    truncate_dim = None
+_model = None
+
+
+def get_model():
+    """The PyTorch model, loaded on first use."""
+    global _model
+    if _model is None:
+        from transformers import AutoModel
+
+        _model = AutoModel.from_pretrained(MODEL_NAME, trust_remote_code=True)
+    return _model
+
+
+def generate_embeddings(inputs, input_type, truncate_dim=None):
     if input_type == "text":
-        return model.encode_text(inputs, truncate_dim=truncate_dim)
+        return get_model().encode_text(inputs, truncate_dim=truncate_dim)
     elif input_type == "image":
-        model.encode_image(
+        return get_model().encode_image(
             inputs, truncate_dim=truncate_dim
         )  # also accepts PIL.Image.Image, local filenames, dataURI
     return None
 
 
+def truncate_embeddings(embeddings: np.ndarray, truncate_dim: int | None) -> np.ndarray:
+    """Matryoshka truncation: keep the first truncate_dim dimensions and re-normalize."""
+    embeddings = embeddings.astype(np.float32)
+    if truncate_dim:
+        embeddings = embeddings[:, :truncate_dim]
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def load_image(image: str):
+    """
+    Opens a base64 string or data URI as an RGB PIL image. Inputs come from
+    query requests, so URLs are refused rather than fetched and nothing is
+    read from disk; prepare_query_images downloads allowlisted URLs first.
+    """
+    from PIL import Image
+
+    if image.startswith(("http://", "https://")):
+        raise ValueError("Images must be sent as base64 or data URIs")
+    data = base64.b64decode(image.split(",", 1)[-1])
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+
+class OnnxEmbedder:
+    """
+    CPU embedding backend for jina-clip-v2 exported to ONNX.
+
+    The exported graph takes `input_ids` and `pixel_values` together and
+    returns normalized text and image embeddings as its last two outputs, so
+    text-only and image-only batches are run with a one-row placeholder for
+    the other modality. Graphs exported without an `attention_mask` input
+    cannot tell padding from text, so their texts are run one at a time.
+    """
+
+    def __init__(self, model_path: str = ONNX_MODEL_PATH, threads: int = ONNX_THREADS):
+        import onnxruntime as ort
+        from transformers import AutoConfig, AutoImageProcessor, AutoTokenizer
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {x.name for x in self.session.get_inputs()}
+        pixel_input = next(x for x in self.session.get_inputs() if x.name == "pixel_values")
+        self.pixel_dtype = np.float16 if "float16" in pixel_input.type else np.float32
+        self.text_batch_size = ONNX_TEXT_BATCH_SIZE
+        if "attention_mask" not in self.input_names and self.text_batch_size > 1:
+            print(f"{model_path} has no attention_mask input, embedding texts without padding, one at a time")
+            self.text_batch_size = 1
+        config = AutoConfig.from_pretrained(MODEL_NAME, trust_remote_code=True)
+        self.task_instructions = getattr(config, "task_instructions", None) or TASK_INSTRUCTIONS
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
+        self.image_processor = AutoImageProcessor.from_pretrained(MODEL_NAME, trust_remote_code=True)
+
+    def _run(self, input_ids: np.ndarray, pixel_values: np.ndarray, attention_mask=None):
+        feeds = {"input_ids": input_ids, "pixel_values": pixel_values.astype(self.pixel_dtype)}
+        if "attention_mask" in self.input_names:
+            feeds["attention_mask"] = (
+                attention_mask if attention_mask is not None else np.ones_like(input_ids)
+            )
+        *_, text_embeddings, image_embeddings = self.session.run(None, feeds)
+        return text_embeddings, image_embeddings
+
+    def encode_text(
+        self, texts: list[str], truncate_dim: int | None = None, task: str | None = None
+    ) -> np.ndarray:
+        """Embeds texts, prefixed with the instruction for task if it has one."""
+        instruction = self.task_instructions.get(task, "") if task else ""
+        texts = [instruction + text for text in texts]
+        placeholder = np.zeros((1, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+        results = [None] * len(texts)
+        # Sorting by length keeps padding inside each batch to a minimum
+        lengths = [len(x) for x in self.tokenizer(texts)["input_ids"]]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        for start in range(0, len(order), self.text_batch_size):
+            batch = order[start : start + self.text_batch_size]
+            encoded = self.tokenizer(
+                [texts[i] for i in batch],
+                padding=len(batch) > 1,
+                truncation=True,
+                max_length=ONNX_MAX_TEXT_TOKENS,
+                return_tensors="np",
+            )
+            text_embeddings, _ = self._run(
+                encoded["input_ids"], placeholder, encoded.get("attention_mask")
+            )
+            for i, embedding in zip(batch, text_embeddings):
+                results[i] = embedding
+        return truncate_embeddings(np.stack(results), truncate_dim)
+
+    def encode_image(self, images: list[str], truncate_dim: int | None = None) -> np.ndarray:
+        placeholder = self.tokenizer([""], return_tensors="np")["input_ids"]
+        results = []
+        for start in range(0, len(images), ONNX_IMAGE_BATCH_SIZE):
+            batch = [load_image(x) for x in images[start : start + ONNX_IMAGE_BATCH_SIZE]]
+            pixel_values = self.image_processor(batch, return_tensors="np")["pixel_values"]
+            _, image_embeddings = self._run(placeholder, pixel_values)
+            results.extend(image_embeddings)
+        return truncate_embeddings(np.stack(results), truncate_dim)
+
+    def embed(
+        self, inputs: list[dict[str, str]], truncate_dim: int | None = None, task: str | None = None
+    ) -> list[dict]:
+        """
+        Embeds Jina-style inputs ({"text": ...} or {"image": ...}) and returns
+        data in the shape of Jina's embeddings response. task is the Jina task,
+        e.g. "retrieval.query", and only changes how texts are embedded.
+        """
+        texts = [(i, x["text"]) for i, x in enumerate(inputs) if "text" in x]
+        images = [(i, x["image"]) for i, x in enumerate(inputs) if "image" in x]
+        embeddings = [None] * len(inputs)
+        if texts:
+            for (i, _), emb in zip(texts, self.encode_text([x for _, x in texts], truncate_dim, task)):
+                embeddings[i] = emb
+        if images:
+            for (i, _), emb in zip(images, self.encode_image([x for _, x in images], truncate_dim)):
+                embeddings[i] = emb
+        return [{"index": i, "embedding": emb.tolist()} for i, emb in enumerate(embeddings)]
+
+
+class EmbeddingRunner:
+    """
+    Runs an OnnxEmbedder on a small thread pool. ONNX Runtime releases the GIL
+    while it computes, so async callers can await embeddings without blocking
+    the event loop.
+    """
+
+    def __init__(self, embedder: OnnxEmbedder, workers: int = ONNX_RUNNER_WORKERS):
+        self.embedder = embedder
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="onnx-embed")
+
+    def embed(
+        self, inputs: list[dict[str, str]], truncate_dim: int | None = None, task: str | None = None
+    ) -> list[dict]:
+        return self.pool.submit(self.embedder.embed, inputs, truncate_dim, task).result()
+
+    async def aembed(
+        self, inputs: list[dict[str, str]], truncate_dim: int | None = None, task: str | None = None
+    ) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, self.embedder.embed, inputs, truncate_dim, task)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
 if __name__ == "__main__":
     vals = generate_embeddings(["Hello"], "text")
-# # !pip install transformers onnxruntime pillow
-# import onnxruntime as ort
-# from transformers import AutoImageProcessor, AutoTokenizer
-# import numpy as np
-#
-# # Load tokenizer and image processor using transformers
-# tokenizer = AutoTokenizer.from_pretrained('jinaai/jina-clip-v2', trust_remote_code=True)
-# image_processor = AutoImageProcessor.from_pretrained(
-#     'jinaai/jina-clip-v2', trust_remote_code=True
-# )
-#
-# # Corpus
-# sentences = [
-#     'غروب جميل على الشاطئ', # Arabic
-#     '海滩上美丽的日落', # Chinese
-#     'Un beau coucher de soleil sur la plage', # French
-#     'Ein wunderschöner Sonnenuntergang am Strand', # German
-#     'Ένα όμορφο ηλιοβασίλεμα πάνω από την παραλία', # Greek
-#     'समुद्र तट पर एक खूबसूरत सूर्यास्त', # Hindi
-#     'Un bellissimo tramonto sulla spiaggia', # Italian
-#     '浜辺に沈む美しい夕日', # Japanese
-#     '해변 위로 아름다운 일몰', # Korean
-# ]
-#
-# # Public image URLs or PIL Images
-# image_urls = ['https://i.ibb.co/nQNGqL0/beach1.jpg', 'https://i.ibb.co/r5w8hG8/beach2.jpg']
-#
-# # Tokenize input texts and transform input images
-# input_ids = tokenizer(sentences, return_tensors='np')['input_ids']
-# pixel_values = np.zeros((len(sentences), 3, 512, 512), dtype=np.float32)
-#
-# # Start an ONNX Runtime Session
-# session = ort.InferenceSession('/home/arun/Downloads/model_fp16.onnx')
-#
-# # Run inference
-# output = session.run(None, {'input_ids': input_ids, 'pixel_values': pixel_values })
-#
-# # Keep the normalised embeddings, first 2 outputs are un-normalized
-# _, _, text_embeddings, image_embeddings = output
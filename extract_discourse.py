@@ -1,10 +1,12 @@
-from datetime import datetime
-
-import requests
+import argparse
+import asyncio
 import json
+import random
+import time
 from dotenv import load_dotenv
 import os
-from urllib.parse import quote
+
+import httpx
 
 load_dotenv()
 
@@ -13,48 +15,320 @@ PASSWORD = os.getenv("DISCOURSE_PASSWORD")
 BASE_URL = os.getenv("DISCOURSE_URL")
 COURSE_CATEGORY_ID = "34"
 
+# Crawl tuning
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+CRAWL_RATE_LIMIT = float(os.getenv("CRAWL_RATE_LIMIT", "5"))  # requests per second
+CRAWL_MAX_RETRIES = int(os.getenv("CRAWL_MAX_RETRIES", "5"))
+POST_IDS_PER_REQUEST = int(os.getenv("POST_IDS_PER_REQUEST", "50"))
 
-if not all([BASE_URL, USERNAME, PASSWORD]):
-    print(
-        "Error: Please make sure DISCOURSE_URL, DISCOURSE_USERNAME, and DISCOURSE_PASSWORD are set in your .env file."
-    )
-    exit()
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+
+class RateLimiter:
+    """Async limiter allowing at most `rate` request starts per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        """Pushes every future request back, used when the server answers 429."""
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+def output_key(output_path: str) -> str:
+    stat = os.stat(output_path)
+    return f"{stat.st_size} {stat.st_mtime_ns}"
+
+
+def commit_crawl_state(output_path: str, state_path: str | None = None) -> bool:
+    """
+    Makes the ETags seen by the crawl that wrote output_path the ones the next
+    crawl sends. Call it once that output has been ingested: until then every
+    crawl fetches the topics it changed again, so no update is lost to a
+    failed or skipped ingestion.
+    """
+    state_path = state_path or output_path + ".state.json"
+    pending_path = state_path + ".pending"
+    if not os.path.exists(pending_path) or not os.path.exists(output_path):
+        return False
+    with open(pending_path) as f:
+        pending = json.load(f)
+    if pending.get("output") != output_key(output_path):
+        print(f"Not committing {pending_path}: {output_path} was written by another crawl")
+        return False
+    write_json(state_path, pending["state"])
+    os.remove(pending_path)
+    print(f"Committed crawl state to {state_path}")
+    return True
+
+
+def write_json(path: str, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
 
 
-session = requests.Session()
-session.headers.update(
-    {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-)
+class DiscourseCrawler:
+    """
+    Crawls every topic of a Discourse category and streams each one to a JSONL
+    file as soon as all of its posts have been fetched.
 
+    Topic list pages and post streams are fetched concurrently, posts are
+    requested in batches of post ids, requests are rate limited and retried
+    with backoff on 429/5xx, and topic requests carry ETag/If-Modified-Since
+    from the last ingested crawl so unchanged topics are skipped.
 
-print(f"Fetching CSRF token from {BASE_URL}...")
-csrf_url = f"{BASE_URL}/session/csrf.json"
-csrf_response = session.get(csrf_url)
-csrf_response.raise_for_status()
+    Changed topics are written in full. Every other listed topic, unchanged or
+    failed, gets an {"id": ..., "unchanged": true} line, so ingestion can tell
+    them from deleted topics. The new ETags are kept pending until
+    commit_crawl_state confirms the output was ingested.
+    """
 
-csrf_token = csrf_response.json()["csrf"]
-print(f"Successfully fetched CSRF token: {csrf_token}")
+    def __init__(
+        self,
+        base_url: str,
+        category_id: str,
+        output_path: str,
+        state_path: str | None = None,
+        concurrency: int = CRAWL_CONCURRENCY,
+        rate_limit: float = CRAWL_RATE_LIMIT,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.category_id = category_id
+        self.output_path = output_path
+        self.state_path = state_path or output_path + ".state.json"
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(max_connections=concurrency),
+            timeout=httpx.Timeout(30, connect=10),
+            transport=transport,
+        )
+        self.state: dict[str, dict] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        # Committed state plus what this crawl saw; saved as pending
+        self.new_state = dict(self.state)
+        self.stats = {"topics": 0, "unchanged": 0, "failed": 0, "posts": 0}
 
-session.headers.update({"X-CSRF-Token": csrf_token})
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        for attempt in range(CRAWL_MAX_RETRIES + 1):
+            async with self.semaphore:
+                await self.rate_limiter.wait()
+                try:
+                    response = await self.client.request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    response = None
+                    error = str(e)
+            if response is not None and response.status_code != 429 and response.status_code < 500:
+                return response
+            if attempt == CRAWL_MAX_RETRIES:
+                if response is None:
+                    raise httpx.TransportError(error)
+                response.raise_for_status()
+            delay = min(60, 2**attempt) + random.random()
+            if response is not None and response.status_code == 429:
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                self.rate_limiter.pause(delay)
+            print(f"Retrying {url} in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
-login_payload = {"login": USERNAME, "password": PASSWORD}
+    async def login(self, username: str, password: str):
+        print(f"Fetching CSRF token from {self.base_url}...")
+        csrf_response = await self.request("GET", "/session/csrf.json")
+        csrf_response.raise_for_status()
+        csrf_token = csrf_response.json()["csrf"]
+        self.client.headers["X-CSRF-Token"] = csrf_token
 
-print(f"Attempting to log in as '{USERNAME}'...")
-login_url = f"{BASE_URL}/session.json"
-login_response = session.post(login_url, data=login_payload)
-login_response.raise_for_status()
+        print(f"Attempting to log in as '{username}'...")
+        login_response = await self.request(
+            "POST", "/session.json", data={"login": username, "password": password}
+        )
+        login_response.raise_for_status()
+        if "user" not in login_response.json():
+            raise RuntimeError(f"Login failed: {login_response.text}")
+        print("Login successful!")
 
-if "user" in login_response.json():
-    print("Login successful!")
+    async def list_topics(self) -> list[dict]:
+        """Fetches topic list pages concurrently, a window at a time, until one comes back empty."""
+        topics, page, done = [], 0, False
+        window = max(1, self.concurrency)
+        while not done:
+            responses = await asyncio.gather(
+                *(
+                    self.request("GET", f"/c/{self.category_id}.json", params={"page": p})
+                    for p in range(page, page + window)
+                )
+            )
+            for response in responses:
+                response.raise_for_status()
+                topic_list = response.json()["topic_list"]
+                topics.extend(topic_list["topics"])
+                if not topic_list["topics"] or not topic_list.get("more_topics_url"):
+                    done = True
+                    break
+            page += window
+        # Pages can shift while crawling, so the same topic may show up twice
+        return list({topic["id"]: topic for topic in topics}.values())
 
-    cookies = session.cookies.get_dict()
+    async def fetch_posts(self, topic_id: int, post_ids: list[int]) -> list[dict]:
+        batches = [
+            post_ids[i : i + POST_IDS_PER_REQUEST]
+            for i in range(0, len(post_ids), POST_IDS_PER_REQUEST)
+        ]
+        responses = await asyncio.gather(
+            *(
+                self.request(
+                    "GET",
+                    f"/t/{topic_id}/posts.json",
+                    params=[("post_ids[]", x) for x in batch] + [("include_raw", "true")],
+                )
+                for batch in batches
+            )
+        )
+        posts = []
+        for response in responses:
+            response.raise_for_status()
+            posts.extend(response.json()["post_stream"]["posts"])
+        return posts
 
-    if "_t" in cookies:
-        print(f"Authentication token (_t) captured successfully.")
+    async def crawl_topic(self, topic_id: int) -> dict | None:
+        """Returns the topic with all its posts, or None if it is unchanged since the last crawl."""
+        url = f"/t/{topic_id}.json"
+        cached = self.state.get(url, {})
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
 
-else:
-    print("Login failed. Check your credentials or the website's response.")
-    print("Response:", login_response.text)
+        response = await self.request("GET", url, headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        topic = response.json()
 
+        post_ids = topic["post_stream"]["stream"]
+        posts = await self.fetch_posts(topic_id, post_ids)
+        posts.sort(key=lambda x: x["post_number"])
+        slug = topic.get("slug", "")
+
+        self.new_state[url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        return {
+            "id": topic["id"],
+            "title": topic["title"],
+            "slug": slug,
+            "created_at": topic.get("created_at"),
+            "posts": [
+                {
+                    "id": post["id"],
+                    "topic_id": topic["id"],
+                    "post_number": post["post_number"],
+                    "reply_to_post_number": post.get("reply_to_post_number"),
+                    "username": post.get("username"),
+                    "created_at": post.get("created_at"),
+                    "raw": post.get("raw") or post.get("cooked", ""),
+                    "url": f"{self.base_url}/t/{slug}/{topic['id']}/{post['post_number']}",
+                }
+                for post in posts
+            ],
+        }
+
+    def save_pending_state(self):
+        write_json(
+            self.state_path + ".pending",
+            {"output": output_key(self.output_path), "state": self.new_state},
+        )
+
+    async def crawl(self):
+        topics = await self.list_topics()
+        print(f"Found {len(topics)} topics in category {self.category_id}")
+
+        # Written next to the output and swapped in at the end, so an output
+        # that is still being ingested is never truncated
+        tmp_path = self.output_path + ".tmp"
+        with open(tmp_path, "w") as out:
+
+            async def crawl_and_write(topic_id: int):
+                try:
+                    topic = await self.crawl_topic(topic_id)
+                except httpx.HTTPError as e:
+                    self.stats["failed"] += 1
+                    print(f"Failed to crawl topic {topic_id}: {e}")
+                    topic = None
+                else:
+                    if topic is None:
+                        self.stats["unchanged"] += 1
+                if topic is None:
+                    # Still listed, so ingestion must keep whatever it has for it
+                    out.write(json.dumps({"id": topic_id, "unchanged": True}) + "\n")
+                    return
+                out.write(json.dumps(topic) + "\n")
+                out.flush()
+                self.stats["topics"] += 1
+                self.stats["posts"] += len(topic["posts"])
+
+            await asyncio.gather(*(crawl_and_write(topic["id"]) for topic in topics))
+
+        os.replace(tmp_path, self.output_path)
+        self.save_pending_state()
+        print(f"Crawl finished: {self.stats}")
+        return self.stats
+
+    async def close(self):
+        await self.client.aclose()
+
+
+async def main(output_path: str, category_id: str = COURSE_CATEGORY_ID):
+    crawler = DiscourseCrawler(BASE_URL, category_id, output_path)
+    try:
+        await crawler.login(USERNAME, PASSWORD)
+        cookies = dict(crawler.client.cookies)
+        if "_t" in cookies:
+            print("Authentication token (_t) captured successfully.")
+        await crawler.crawl()
+    finally:
+        await crawler.close()
+
+
+if __name__ == "__main__":
+    if not all([BASE_URL, USERNAME, PASSWORD]):
+        print(
+            "Error: Please make sure DISCOURSE_URL, DISCOURSE_USERNAME, and DISCOURSE_PASSWORD are set in your .env file."
+        )
+        exit()
+
+    parser = argparse.ArgumentParser(description="Crawl a Discourse category to JSONL")
+    parser.add_argument("output", nargs="?", default="topics.jsonl")
+    parser.add_argument("--category", default=COURSE_CATEGORY_ID)
+    parser.add_argument(
+        "--commit",
+        action="store_true",
+        help="Only confirm that the output was ingested, so the next crawl skips its topics",
+    )
+    args = parser.parse_args()
+    if args.commit:
+        commit_crawl_state(args.output)
+    else:
+        asyncio.run(main(args.output, args.category))
@@ -1,68 +1,591 @@
-from pinecone import Pinecone, ServerlessSpec
-from dotenv import load_dotenv
+import argparse
+import asyncio
+import json
+import multiprocessing
 import os
+import random
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncIterator, Iterator
 
-load_dotenv()
+import httpx
+import numpy as np
+from dotenv import load_dotenv
+from pinecone import Pinecone, ServerlessSpec
 
-pc = Pinecone(api_key="PINECONE_API_KEY")
+load_dotenv()
 
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 JINA_API_KEY = os.getenv("JINA_API_KEY")
-dimension = 1024
+JINA_API_ENDPOINT = os.getenv("JINA_API_ENDPOINT", "https://api.jina.ai/v1/embeddings")
+JINA_EMBEDDING_MODEL_NAME = os.getenv("JINA_EMBEDDING_MODEL_NAME", "jina-clip-v2")
+dimension = int(os.getenv("JINA_EMBEDDING_MODEL_DIMENSIONS", "1024"))
+
+index_name = os.getenv("PINECONE_INDEX_NAME", "jina-clip-v2")
+namespace = os.getenv("PINECONE_NAMESPACE", "tds-p1")
+
+# Ingestion tuning
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
+UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", "4"))
+MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "5"))
+# Chunking processes (each loads the tokenizer once); 1 chunks on a single background thread
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", str(os.cpu_count() or 1)))
+# Topics per chunking task; the batched tokenizer pre-pass covers a whole task
+CHUNK_TOPICS_PER_TASK = int(os.getenv("CHUNK_TOPICS_PER_TASK", "16"))
+# Tasks handed to the chunkers ahead of the embedding stage, per worker
+CHUNK_PREFETCH = int(os.getenv("CHUNK_PREFETCH", "2"))
+CHECKPOINT_PATH = os.getenv("INGEST_CHECKPOINT_PATH", "ingest_checkpoint.txt")
+MANIFEST_PATH = os.getenv("INGEST_MANIFEST_PATH", "ingest_manifest.sqlite3")
+# Memory-mapped corpus snapshot for VECTOR_BACKEND=snapshot; empty to skip writing it
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "snapshot")
+SNAPSHOT_DTYPE = os.getenv("SNAPSHOT_DTYPE", "float16")
+
+# Where the index generation stamp lives; the serving app tags cached answers
+# with it, so bumping it after a run makes old answers stale on every instance
+INDEX_GENERATION_NAMESPACE = os.getenv("INDEX_GENERATION_NAMESPACE", f"{namespace}-meta")
+INDEX_GENERATION_ID = "index-generation"
+
+# Serving app endpoint to clear its answer cache once the index has changed
+CACHE_INVALIDATE_URL = os.getenv("CACHE_INVALIDATE_URL")
+CACHE_ADMIN_TOKEN = os.getenv("CACHE_ADMIN_TOKEN")
+
+
+def get_index():
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    if not pc.has_index(index_name):
+        pc.create_index(
+            name=index_name,
+            dimension=dimension,
+            metric="cosine",
+            spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+        )
+    return pc.Index(index_name)
+
+
+def read_topics(topics_path: str) -> Iterator[dict]:
+    """Streams topics from the crawler's JSONL output, one per line."""
+    with open(topics_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def live_topics(topics: Iterator[dict], seen: set[str]) -> Iterator[dict]:
+    """
+    Adds every topic id in the input to `seen` and drops the crawler's
+    {"id": ..., "unchanged": true} markers, which have nothing to re-index.
+    """
+    for topic in topics:
+        seen.add(str(topic["id"]))
+        if not topic.get("unchanged"):
+            yield topic
+
+
+def topic_posts(topic: dict) -> list[dict]:
+    """Flat post list in the shape build_reply_hierarchy/create_hierarchical_chunks expect."""
+    posts = []
+    for post in topic["posts"]:
+        post = dict(post)
+        post.setdefault("title", topic["title"])
+        post.setdefault("topic_id", topic["id"])
+        post.setdefault("url", post.get("post_url", ""))
+        posts.append(post)
+    return posts
+
+
+def chunk_topics(topics: list[dict]) -> list[tuple[str, list[dict]]]:
+    """(topic_id, chunks) for a batch of topics, with one tokenizer pre-pass over all of them."""
+    from utils import build_reply_hierarchy, create_hierarchical_chunks, pretokenize_threads
+
+    trees = [build_reply_hierarchy(topic_posts(topic)) for topic in topics]
+    pretokenize_threads([thread for tree in trees for thread in tree])
+    return [
+        (str(topic["id"]), create_hierarchical_chunks(tree, pretokenize=False))
+        for topic, tree in zip(topics, trees)
+    ]
+
 
-index_name = "jina-clip-v2"
-namespace = "tds-p1"
+def batched_topics(topics: Iterator[dict], skip_topics: set[str], size: int) -> Iterator[list[dict]]:
+    batch = []
+    for topic in topics:
+        if str(topic["id"]) in skip_topics:
+            continue
+        batch.append(topic)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-if not pc.has_index(index_name):
-    pc.create_index(
-        name=index_name,
-        dimension=dimension,
-        metric="cosine",
-        spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+
+def init_chunk_worker():
+    # Importing utils loads the tokenizer, once per worker rather than per topic
+    import utils  # noqa: F401
+
+
+def make_chunk_executor(workers: int = CHUNK_WORKERS) -> Executor:
+    if workers <= 1:
+        return ThreadPoolExecutor(max_workers=1, initializer=init_chunk_worker)
+    # spawn, not fork: the parent already runs an event loop and client threads
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_chunk_worker,
     )
 
-index = pc.Index(index_name)
 
-from typing import List
-import requests
+async def aiter_chunks(
+    topics: Iterator[dict],
+    skip_topics: set[str],
+    workers: int = CHUNK_WORKERS,
+    prefetch: int = CHUNK_PREFETCH,
+    topics_per_task: int = CHUNK_TOPICS_PER_TASK,
+) -> AsyncIterator[tuple[str, list[dict]]]:
+    """
+    Yields (topic_id, chunks) per topic, chunked on a pool of worker
+    processes in tasks of topics_per_task topics so each pre-tokenization
+    pass is batched across topics. Topics in skip_topics are left out.
 
+    Topics are read lazily and at most workers * prefetch tasks are in
+    flight, so memory stays flat. Results are yielded in input order, which
+    keeps checkpoints and upserts deterministic across runs.
+    """
+    loop = asyncio.get_running_loop()
+    pending: deque = deque()
+    window = max(1, workers) * prefetch
+    with make_chunk_executor(workers) as executor:
+        for batch in batched_topics(topics, skip_topics, max(1, topics_per_task)):
+            pending.append(loop.run_in_executor(executor, chunk_topics, batch))
+            if len(pending) >= window:
+                for result in await pending.popleft():
+                    yield result
+        while pending:
+            for result in await pending.popleft():
+                yield result
 
-def get_embeddings(
-    inputs: List[str],
-    dimensions: int,
-):
+
+def chunk_to_vector(chunk: dict, embedding: list[float]) -> dict:
+    return {
+        "id": chunk["chunked_id"],
+        "values": embedding,
+        "metadata": {
+            "content": chunk["content"],
+            "url": chunk["url"],
+            "topic_id": chunk["topic_id"],
+            "post_id": chunk["post_id"],
+            "topic_title": chunk["topic_title"],
+            "chunk_index": chunk["chunk_index"],
+            "total_chunks": chunk["total_chunks"],
+        },
+    }
+
+
+async def with_retries(func, *args, description: str = "request"):
+    """Runs an async callable, retrying with exponential backoff and jitter."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await func(*args)
+        except Exception as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(60, 2**attempt) + random.random()
+            print(f"{description} failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def get_embeddings(client: httpx.AsyncClient, inputs: list[dict[str, str]]) -> list[list[float]]:
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {JINA_API_KEY}",
     }
     data = {
+        "task": "retrieval.passage",
         "input": inputs,
-        "model": "jina-clip-v2",
-        "dimensions": dimensions,
+        "model": JINA_EMBEDDING_MODEL_NAME,
+        "dimensions": dimension,
     }
+    response = await client.post(JINA_API_ENDPOINT, headers=headers, json=data)
+    response.raise_for_status()
+    embeddings = sorted(response.json()["data"], key=lambda x: x["index"])
+    return [x["embedding"] for x in embeddings]
+
+
+def input_key(topics_path: str) -> str:
+    """Identifies one version of an input file: its path, size and modification time."""
+    stat = os.stat(topics_path)
+    return f"{os.path.abspath(topics_path)} {stat.st_size} {stat.st_mtime_ns}"
+
+
+class Checkpoint:
+    """
+    Append-only list of fully ingested topic ids. A topic is recorded only
+    after every one of its chunks has been upserted, so a crashed run resumes
+    from the first incomplete topic.
+
+    The first line holds the input_key of the file being ingested. A
+    checkpoint written for another input, or another version of the same
+    file, is discarded, so a new crawl is never skipped as already done.
+    """
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.done: set[str] = set()
+        header = f"# {key}"
+        lines = []
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = [line.strip() for line in f if line.strip()]
+        if lines and lines[0] == header:
+            self.done = set(lines[1:])
+        else:
+            if lines:
+                print(f"Discarding {path}: it was written for a different input")
+            with open(path, "w") as f:
+                f.write(header + "\n")
+        self.remaining: dict[str, int] = {}
+        self.produced: set[str] = set()
+
+    def add_chunks(self, topic_id: str, count: int):
+        self.remaining[topic_id] = self.remaining.get(topic_id, 0) + count
+
+    def finish_producing(self, topic_id: str):
+        self.produced.add(topic_id)
+        self._maybe_complete(topic_id)
+
+    def upserted(self, topic_id: str, count: int = 1):
+        self.remaining[topic_id] -= count
+        self._maybe_complete(topic_id)
+
+    def _maybe_complete(self, topic_id: str):
+        if topic_id in self.produced and self.remaining.get(topic_id, 0) == 0:
+            self.remaining.pop(topic_id, None)
+            self.produced.discard(topic_id)
+            self.done.add(topic_id)
+            with open(self.path, "a") as f:
+                f.write(topic_id + "\n")
+
 
-    response = requests.post(
-        "https://api.jina.ai/v1/embeddings", headers=headers, json=data
+class Manifest:
+    """
+    What is currently in the index: chunked_id -> (topic_id, content_hash).
+    Lets a re-ingestion embed only new or changed chunks and delete the rest.
+
+    It also keeps a local copy of every upserted vector and its metadata,
+    updated only for the chunks a run changes, so the corpus snapshot can be
+    rebuilt without reading the namespace back from Pinecone.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest "
+            "(chunked_id TEXT PRIMARY KEY, topic_id TEXT, content_hash TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS manifest_topic ON manifest (topic_id)")
+        # float32 embedding bytes and JSON metadata, as upserted
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors "
+            "(chunked_id TEXT PRIMARY KEY, embedding BLOB, metadata TEXT)"
+        )
+        self.conn.commit()
+
+    def topic_hashes(self, topic_id: str) -> dict[str, str]:
+        rows = self.conn.execute(
+            "SELECT chunked_id, content_hash FROM manifest WHERE topic_id = ?", (topic_id,)
+        )
+        return dict(rows)
+
+    def topic_ids(self) -> set[str]:
+        return {row[0] for row in self.conn.execute("SELECT DISTINCT topic_id FROM manifest")}
+
+    def record(self, chunks: list[dict], vectors: list[dict]):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?)",
+            [(c["chunked_id"], str(c["topic_id"]), c["content_hash"]) for c in chunks],
+        )
+        self.store_vectors(vectors, commit=False)
+        self.conn.commit()
+
+    def store_vectors(self, vectors: list[dict], commit: bool = True):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+            [
+                (v["id"], np.asarray(v["values"], dtype=np.float32).tobytes(), json.dumps(v["metadata"]))
+                for v in vectors
+            ],
+        )
+        if commit:
+            self.conn.commit()
+
+    def remove(self, chunk_ids: list[str]):
+        rows = [(x,) for x in chunk_ids]
+        self.conn.executemany("DELETE FROM manifest WHERE chunked_id = ?", rows)
+        self.conn.executemany("DELETE FROM vectors WHERE chunked_id = ?", rows)
+        self.conn.commit()
+
+    def missing_vectors(self) -> list[str]:
+        """Indexed chunks with no local vector, e.g. ingested before vectors were kept."""
+        rows = self.conn.execute(
+            "SELECT chunked_id FROM manifest WHERE chunked_id NOT IN (SELECT chunked_id FROM vectors)"
+        )
+        return [row[0] for row in rows]
+
+    def vector_count(self) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM vectors WHERE chunked_id IN (SELECT chunked_id FROM manifest)"
+        ).fetchone()[0]
+
+    def iter_vectors(self) -> Iterator[tuple[str, np.ndarray, dict]]:
+        """Streams (chunked_id, embedding, metadata) for every indexed chunk, in id order."""
+        rows = self.conn.execute(
+            "SELECT v.chunked_id, v.embedding, v.metadata FROM vectors v "
+            "JOIN manifest m ON m.chunked_id = v.chunked_id ORDER BY v.chunked_id"
+        )
+        for chunked_id, embedding, metadata in rows:
+            yield chunked_id, np.frombuffer(embedding, dtype=np.float32), json.loads(metadata)
+
+
+def diff_topic(manifest: Manifest, topic_id: str, chunks: list[dict]) -> tuple[list[dict], list[str]]:
+    """Returns (chunks to embed and upsert, chunk ids to delete) for one topic."""
+    known = manifest.topic_hashes(topic_id)
+    changed = [c for c in chunks if known.get(c["chunked_id"]) != c["content_hash"]]
+    current = {c["chunked_id"] for c in chunks}
+    stale = [chunk_id for chunk_id in known if chunk_id not in current]
+    return changed, stale
+
+
+def write_index_generation(index) -> str:
+    generation = str(time.time_ns())
+    # Pinecone stores a vector with every record; a unit vector is valid for any metric
+    values = [1.0] + [0.0] * (dimension - 1)
+    index.upsert(
+        vectors=[{"id": INDEX_GENERATION_ID, "values": values, "metadata": {"generation": generation}}],
+        namespace=INDEX_GENERATION_NAMESPACE,
     )
-    return response.json()
-
-
-data = [
-    {"id": "img1", "modality": "image", "content": "<https://example.com/image1.jpg>"},
-    {"id": "txt1", "modality": "text", "content": "A red apple on a table."},
-    {"id": "img2", "modality": "image", "content": "<https://example.com/image2.png>"},
-    {"id": "txt2", "modality": "text", "content": "A basket of green apples."},
-]
-
-vectors = []
-for item in data:
-    embeddings = get_embeddings([item["content"]], dimensions=dimension)
-    embedding = embeddings["data"][0]["embedding"]
-    vectors.append(
-        {
-            "id": item["id"],
-            "values": embedding,
-            "metadata": {"content": item["content"], "modality": item["modality"]},
-        }
+    print(f"Index generation is now {generation}")
+    return generation
+
+
+def notify_index_changed():
+    if not CACHE_INVALIDATE_URL:
+        return
+    if not CACHE_ADMIN_TOKEN:
+        print("Warning: CACHE_ADMIN_TOKEN is not set, not invalidating the answer cache")
+        return
+    try:
+        response = httpx.post(CACHE_INVALIDATE_URL, headers={"X-Admin-Token": CACHE_ADMIN_TOKEN})
+    except httpx.HTTPError as e:
+        print(f"Could not invalidate answer cache: {e}")
+        return
+    if response.is_success:
+        print("Answer cache invalidated")
+    else:
+        print(f"Could not invalidate answer cache: HTTP {response.status_code} {response.text[:200]}")
+
+
+async def ingest(
+    topics_path: str,
+    checkpoint_path: str = CHECKPOINT_PATH,
+    manifest_path: str = MANIFEST_PATH,
+    prune_missing: bool = False,
+    snapshot_path: str | None = SNAPSHOT_PATH,
+    crawl_state_path: str | None = None,
+):
+    """
+    Streams chunks from the chunking pool, embeds them in batched multi-input Jina
+    requests and upserts them to Pinecone in fixed-size batches.
+
+    At most EMBED_CONCURRENCY embedding batches are in flight and the queue in
+    front of them is bounded, so memory stays flat regardless of corpus size.
+    Chunks whose content hash matches the manifest are skipped and chunks that
+    disappeared from a topic are deleted; with prune_missing, topics absent
+    from the input, counting the crawler's unchanged markers, are deleted as
+    well. Once every chunk made it in, the crawl that wrote the input is
+    committed, so the next crawl skips the topics it fetched. If anything
+    changed, the vectors kept in the manifest are written to snapshot_path
+    as a corpus snapshot.
+    """
+    index = get_index()
+    checkpoint = Checkpoint(checkpoint_path, input_key(topics_path))
+    manifest = Manifest(manifest_path)
+    print(f"Resuming after {len(checkpoint.done)} completed topics")
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=EMBED_CONCURRENCY * 2)
+    upsert_semaphore = asyncio.Semaphore(UPSERT_CONCURRENCY)
+    total = {"chunks": 0, "failed": 0, "unchanged": 0, "deleted": 0}
+
+    async def delete_batch(chunk_ids: list[str]):
+        await asyncio.to_thread(index.delete, ids=chunk_ids, namespace=namespace)
+
+    async def delete(chunk_ids: list[str]):
+        for i in range(0, len(chunk_ids), UPSERT_BATCH_SIZE):
+            ids = chunk_ids[i : i + UPSERT_BATCH_SIZE]
+            await with_retries(delete_batch, ids, description="Delete")
+            manifest.remove(ids)
+        total["deleted"] += len(chunk_ids)
+
+    async def upsert(vectors: list[dict]):
+        async with upsert_semaphore:
+            await asyncio.to_thread(index.upsert, vectors=vectors, namespace=namespace)
+
+    # Embedded (topic_id, chunk, vector) waiting for a full upsert batch
+    pending: list[tuple[str, dict, dict]] = []
+
+    async def flush(items: list[tuple[str, dict, dict]]):
+        vectors = [vector for _, _, vector in items]
+        try:
+            await with_retries(upsert, vectors, description="Upsert")
+        except Exception as e:
+            # Its topics stay out of the checkpoint and are redone on the next run
+            total["failed"] += len(items)
+            print(f"Giving up on an upsert of {len(items)} chunks: {e}")
+            return
+        manifest.record([chunk for _, chunk, _ in items], vectors)
+        for topic_id, _, _ in items:
+            checkpoint.upserted(topic_id)
+        total["chunks"] += len(items)
+        print(f"Upserted {total['chunks']} chunks")
+
+    async def worker(client: httpx.AsyncClient):
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                queue.task_done()
+                return
+            try:
+                embeddings = await with_retries(
+                    get_embeddings,
+                    client,
+                    [{"text": chunk["content"]} for _, chunk in batch],
+                    description="Embedding batch",
+                )
+            except Exception as e:
+                total["failed"] += len(batch)
+                print(f"Giving up on a batch of {len(batch)} chunks: {e}")
+                queue.task_done()
+                continue
+            pending.extend(
+                (topic_id, chunk, chunk_to_vector(chunk, embedding))
+                for (topic_id, chunk), embedding in zip(batch, embeddings)
+            )
+            queue.task_done()
+            while len(pending) >= UPSERT_BATCH_SIZE:
+                items = pending[:UPSERT_BATCH_SIZE]
+                del pending[:UPSERT_BATCH_SIZE]
+                await flush(items)
+
+    limits = httpx.Limits(max_connections=EMBED_CONCURRENCY, max_keepalive_connections=EMBED_CONCURRENCY)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120, connect=10)) as client:
+        workers = [asyncio.create_task(worker(client)) for _ in range(EMBED_CONCURRENCY)]
+
+        batch = []
+        seen_topics = set(checkpoint.done)
+        topics = live_topics(read_topics(topics_path), seen_topics)
+        async for topic_id, chunks in aiter_chunks(topics, checkpoint.done):
+            changed, stale = diff_topic(manifest, topic_id, chunks)
+            total["unchanged"] += len(chunks) - len(changed)
+            if stale:
+                await delete(stale)
+            checkpoint.add_chunks(topic_id, len(changed))
+            for chunk in changed:
+                batch.append((topic_id, chunk))
+                if len(batch) == EMBED_BATCH_SIZE:
+                    await queue.put(batch)
+                    batch = []
+            checkpoint.finish_producing(topic_id)
+        if batch:
+            await queue.put(batch)
+
+        if prune_missing:
+            for topic_id in manifest.topic_ids() - seen_topics:
+                await delete(list(manifest.topic_hashes(topic_id)))
+
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        if pending:
+            await flush(pending)
+
+    print(
+        f"Ingestion finished: {total['chunks']} chunks upserted, {total['unchanged']} unchanged, "
+        f"{total['deleted']} deleted, {total['failed']} failed, {len(checkpoint.done)} topics complete"
     )
+    if total["failed"] == 0:
+        from extract_discourse import commit_crawl_state
 
-index.upsert(vectors=vectors, namespace=namespace)
+        commit_crawl_state(topics_path, crawl_state_path)
+        if os.path.exists(checkpoint_path):
+            # The run is complete; the next one starts from the manifest alone
+            os.remove(checkpoint_path)
+    changed = bool(total["chunks"] or total["deleted"])
+    if snapshot_path and (changed or not os.path.exists(snapshot_path)):
+        write_corpus_snapshot(manifest, index, snapshot_path)
+    if changed:
+        write_index_generation(index)
+        notify_index_changed()
+
+
+def backfill_vectors(manifest: Manifest, index, batch_size: int = 100):
+    """
+    Fetches the vectors the manifest has no local copy of from Pinecone, by id.
+    Only chunks ingested before vectors were kept locally need this, once.
+    """
+    missing = manifest.missing_vectors()
+    if not missing:
+        return
+    print(f"Fetching {len(missing)} vectors with no local copy from Pinecone")
+    for i in range(0, len(missing), batch_size):
+        fetched = index.fetch(ids=missing[i : i + batch_size], namespace=namespace).vectors
+        manifest.store_vectors(
+            [
+                {"id": vector_id, "values": vector.values, "metadata": dict(vector.metadata or {})}
+                for vector_id, vector in fetched.items()
+            ]
+        )
+
+
+def write_corpus_snapshot(manifest: Manifest, index, path: str, dtype: str = SNAPSHOT_DTYPE):
+    """
+    Rebuilds the snapshot from the vectors kept in the manifest, streamed so
+    memory stays flat. Nothing is read back from Pinecone, whose reads may not
+    reflect this run's upserts and deletes yet, apart from a one-off backfill.
+    """
+    from snapshot import write_snapshot_rows
+
+    backfill_vectors(manifest, index)
+    count = manifest.vector_count()
+    write_snapshot_rows(path, count, dimension, manifest.iter_vectors(), dtype)
+    print(f"Wrote snapshot of {count} chunks to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed and upsert crawled topics into Pinecone")
+    parser.add_argument("topics", help="JSONL file with one crawled topic per line")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument(
+        "--prune-missing",
+        action="store_true",
+        help="Delete indexed topics that are not in the input (use with a full crawl)",
+    )
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="Corpus snapshot directory")
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not write a corpus snapshot")
+    parser.add_argument(
+        "--crawl-state",
+        help="Crawler state to commit once the input is ingested (default: <topics>.state.json)",
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        ingest(
+            args.topics,
+            args.checkpoint,
+            args.manifest,
+            args.prune_missing,
+            None if args.no_snapshot else args.snapshot,
+            args.crawl_state,
+        )
+    )
@@ -0,0 +1,178 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow generations
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 6000, 8000, 16000, 32000)
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(dict(key))} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (math.inf,)
+        # labels -> [bucket counts..., sum, count]
+        self.values: dict[tuple, list[float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                labels = dict(key)
+                for bound, count in zip(self.buckets, series):
+                    bucket_labels = format_labels({**labels, "le": format_value(bound)})
+                    lines.append(f"{self.name}_bucket{bucket_labels} {format_value(count)}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(series[-2])}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {format_value(series[-1])}")
+        return lines
+
+
+stage_latency = Histogram(
+    "rag_stage_latency_seconds", "Time spent in each stage of answering a query"
+)
+stage_errors = Counter("rag_stage_errors_total", "Exceptions raised per stage")
+request_latency = Histogram(
+    "rag_request_latency_seconds", "End-to-end request latency per endpoint"
+)
+coalesced_queries = Counter(
+    "rag_coalesced_queries_total", "Queries answered by joining an identical in-flight query"
+)
+hedged_requests = Counter(
+    "rag_hedged_requests_total", "Duplicate upstream requests sent because the first was slower than p95"
+)
+degraded_answers = Counter(
+    "rag_degraded_answers_total", "Queries answered with links only because generation was unavailable"
+)
+prompt_tokens = Histogram(
+    "rag_prompt_tokens", "Prompt size in tokens sent to the LLM", TOKEN_BUCKETS
+)
+
+# Timings of the request being handled, in the order the stages ran
+_request_timings: ContextVar[list | None] = ContextVar("request_timings", default=None)
+
+
+def start_request() -> list[tuple[str, float]]:
+    """Starts collecting stage timings for the current request and returns them."""
+    timings: list[tuple[str, float]] = []
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a block as one stage of the current request. The duration goes
+    into the stage histogram and the request's Server-Timing header; an
+    exception is counted against the stage and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_latency.observe(elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def server_timing_header(timings: list[tuple[str, float]]) -> str:
+    # Server-Timing durations are in milliseconds; repeated stages are summed
+    totals: dict[str, float] = {}
+    for name, elapsed in timings:
+        totals[name] = totals.get(name, 0) + elapsed
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in totals.items())
+
+
+def render_cache_stats(caches: dict[str, object]) -> list[str]:
+    """Gauges for the hit/miss counters every cache in cache.py keeps."""
+    lines = [
+        "# HELP rag_cache_hit_rate Fraction of cache lookups that hit",
+        "# TYPE rag_cache_hit_rate gauge",
+    ]
+    stats = {name: cache.stats() for name, cache in caches.items() if cache is not None}
+    for name, values in stats.items():
+        lines.append(f'rag_cache_hit_rate{{cache="{name}"}} {format_value(values["hit_rate"])}')
+    for field in ("hits", "misses", "size"):
+        lines.append(f"# TYPE rag_cache_{field} gauge")
+        for name, values in stats.items():
+            lines.append(f'rag_cache_{field}{{cache="{name}"}} {format_value(values[field])}')
+    return lines
+
+
+def render_breakers(breakers: dict[str, object]) -> list[str]:
+    lines = [
+        "# HELP rag_circuit_open Whether a circuit breaker is failing fast (1) or not (0)",
+        "# TYPE rag_circuit_open gauge",
+    ]
+    for name, breaker in breakers.items():
+        lines.append(f'rag_circuit_open{{upstream="{name}"}} {int(breaker.state == "open")}')
+    return lines
+
+
+def render_metrics(caches: dict[str, object] | None = None, breakers: dict[str, object] | None = None) -> str:
+    """Everything above in the Prometheus text exposition format."""
+    lines = []
+    for metric in (
+        stage_latency,
+        stage_errors,
+        request_latency,
+        coalesced_queries,
+        hedged_requests,
+        degraded_answers,
+        prompt_tokens,
+    ):
+        lines.extend(metric.render())
+    lines.extend(render_cache_stats(caches or {}))
+    lines.extend(render_breakers(breakers or {}))
+    return "\n".join(lines) + "\n"
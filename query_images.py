@@ -0,0 +1,127 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+from urllib.parse import urlparse
+
+# Limits for images sent with a query
+QUERY_IMAGE_MAX_BYTES = int(os.getenv("QUERY_IMAGE_MAX_BYTES", str(5 * 1024 * 1024)))
+QUERY_IMAGE_MAX_COUNT = int(os.getenv("QUERY_IMAGE_MAX_COUNT", "4"))
+# Decoded size limit; a small, highly compressed file can declare far more
+QUERY_IMAGE_MAX_PIXELS = int(os.getenv("QUERY_IMAGE_MAX_PIXELS", str(25_000_000)))
+# jina-clip-v2 works on 512x512 inputs, anything larger is wasted upload
+QUERY_IMAGE_SIZE = int(os.getenv("QUERY_IMAGE_SIZE", "512"))
+QUERY_IMAGE_FORMAT = os.getenv("QUERY_IMAGE_FORMAT", "WEBP")
+QUERY_IMAGE_QUALITY = int(os.getenv("QUERY_IMAGE_QUALITY", "85"))
+# Hosts whose https image URLs the server itself downloads when it embeds
+# locally (EMBEDDING_BACKEND=onnx), comma separated; empty rejects URLs there
+QUERY_IMAGE_URL_HOSTS = {
+    host.strip().lower() for host in os.getenv("QUERY_IMAGE_URL_HOSTS", "").split(",") if host.strip()
+}
+QUERY_IMAGE_FETCH_TIMEOUT = float(os.getenv("QUERY_IMAGE_FETCH_TIMEOUT", "10"))
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+class ImageTooLargeError(InvalidImageError):
+    pass
+
+
+def decode_image(image: str) -> bytes:
+    """Decodes a base64 string or data URI, rejecting it before decoding if too large."""
+    if image.startswith("data:"):
+        image = image.split(",", 1)[-1]
+    if len(image) * 3 // 4 > QUERY_IMAGE_MAX_BYTES:
+        raise ImageTooLargeError(f"Image exceeds {QUERY_IMAGE_MAX_BYTES} bytes")
+    try:
+        return base64.b64decode(image)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidImageError(f"Image is not valid base64: {e}")
+
+
+def fetch_image(url: str) -> bytes:
+    """
+    Downloads a query image from an allowlisted https host, with the same size
+    limit as inline images. Redirects are not followed, so the allowlist cannot
+    be sidestepped through one.
+    """
+    import httpx
+
+    parsed = urlparse(url)
+    if parsed.scheme != "https" or (parsed.hostname or "").lower() not in QUERY_IMAGE_URL_HOSTS:
+        raise InvalidImageError("Image URLs from this host are not accepted, send the image as base64")
+    try:
+        with httpx.stream("GET", url, timeout=QUERY_IMAGE_FETCH_TIMEOUT) as response:
+            if response.status_code != 200:
+                raise InvalidImageError(f"Could not download image: HTTP {response.status_code}")
+            if int(response.headers.get("Content-Length") or 0) > QUERY_IMAGE_MAX_BYTES:
+                raise ImageTooLargeError(f"Image exceeds {QUERY_IMAGE_MAX_BYTES} bytes")
+            data = bytearray()
+            for chunk in response.iter_bytes():
+                data.extend(chunk)
+                if len(data) > QUERY_IMAGE_MAX_BYTES:
+                    raise ImageTooLargeError(f"Image exceeds {QUERY_IMAGE_MAX_BYTES} bytes")
+    except httpx.HTTPError as e:
+        raise InvalidImageError(f"Could not download image: {e}")
+    return bytes(data)
+
+
+def shrink_image(data: bytes) -> bytes:
+    """
+    Downscales to QUERY_IMAGE_SIZE and re-encodes in QUERY_IMAGE_FORMAT.
+    Images declaring more than QUERY_IMAGE_MAX_PIXELS are rejected from their
+    header, before any pixel is decoded.
+    """
+    from PIL import Image
+
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise ImageTooLargeError(f"Image exceeds {QUERY_IMAGE_MAX_PIXELS} pixels")
+    except Exception as e:
+        raise InvalidImageError(f"Could not read image: {e}")
+    width, height = img.size
+    if width * height > QUERY_IMAGE_MAX_PIXELS:
+        raise ImageTooLargeError(f"Image exceeds {QUERY_IMAGE_MAX_PIXELS} pixels")
+    try:
+        img.thumbnail((QUERY_IMAGE_SIZE, QUERY_IMAGE_SIZE))
+    except Exception as e:
+        raise InvalidImageError(f"Could not read image: {e}")
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    if QUERY_IMAGE_FORMAT.upper() == "JPEG" and img.mode == "RGBA":
+        img = img.convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, format=QUERY_IMAGE_FORMAT, quality=QUERY_IMAGE_QUALITY)
+    # Keep the original if re-encoding did not make it smaller
+    return buffer.getvalue() if buffer.tell() < len(data) else data
+
+
+def prepare_query_images(image: str | list[str] | None, fetch_urls: bool = False) -> list[str]:
+    """
+    Turns the request's image field into a list of compact base64 images,
+    dropping duplicates. URLs are passed through for Jina to fetch, or with
+    fetch_urls downloaded here through fetch_image.
+    """
+    if image is None:
+        return []
+    images = [image] if isinstance(image, str) else list(image)
+    if len(images) > QUERY_IMAGE_MAX_COUNT:
+        raise InvalidImageError(f"At most {QUERY_IMAGE_MAX_COUNT} images per query")
+
+    prepared, seen = [], set()
+    for item in images:
+        is_url = item.startswith(("http://", "https://"))
+        if is_url and fetch_urls:
+            data, is_url = fetch_image(item), False
+        else:
+            data = None if is_url else decode_image(item)
+        key = item if is_url else hashlib.sha256(data).hexdigest()
+        if key in seen:
+            continue
+        seen.add(key)
+        prepared.append(item if is_url else base64.b64encode(shrink_image(data)).decode())
+    return prepared
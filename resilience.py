@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+
+
+class StageTimeoutError(TimeoutError):
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"{stage} did not finish within {timeout:.2f}s")
+        self.stage = stage
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class Deadline:
+    """Time budget for one request; each stage gets min(its cap, what is left)."""
+
+    def __init__(self, budget: float):
+        self.expires = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def timeout(self, cap: float | None = None) -> float:
+        return self.remaining() if cap is None else min(cap, self.remaining())
+
+
+# Deadline of the query being answered, if any
+current_deadline: ContextVar[Deadline | None] = ContextVar("current_deadline", default=None)
+
+
+async def within_deadline(awaitable: Awaitable, stage: str, cap: float | None = None):
+    """Awaits under the current deadline (and the stage's cap), raising StageTimeoutError."""
+    deadline = current_deadline.get()
+    timeout = deadline.timeout(cap) if deadline is not None else cap
+    if timeout is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise StageTimeoutError(stage, timeout)
+
+
+class LatencyTracker:
+    """Rolling window of an upstream's latencies, used to decide when to hedge."""
+
+    def __init__(self, window: int = 500, min_samples: int = 20, initial_delay: float = 1.0):
+        self.samples: deque[float] = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def hedge_delay(self) -> float:
+        p95 = self.percentile(95)
+        return self.initial_delay if p95 is None else p95
+
+
+async def hedged(
+    func: Callable[[], Awaitable],
+    tracker: LatencyTracker,
+    on_hedge: Callable[[], None] | None = None,
+):
+    """
+    Calls func, and calls it a second time if the first call is still running
+    after the upstream's p95 latency. Returns whichever finishes first and
+    cancels the other. Only for idempotent reads.
+    """
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(func())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=tracker.hedge_delay())
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            tasks.append(asyncio.ensure_future(func()))
+
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    tracker.record(time.monotonic() - start)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+class CircuitBreaker:
+    """
+    Fails fast after `failure_threshold` consecutive failures. After
+    `reset_timeout` seconds one trial call is let through (half-open); its
+    outcome closes the breaker again or restarts the wait.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Frees the half-open trial slot without a verdict on the upstream."""
+        self.trial_running = False
+
+    @asynccontextmanager
+    async def attempt(self):
+        """
+        Guards one call to the upstream, raising CircuitOpenError if it may not
+        be made. An exception out of the block counts as a failure, a normal
+        exit as a success; cancellation (or a closed generator) only frees the
+        trial slot.
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+        try:
+            yield
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record_success()
@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+from typing import Iterable
+
+import numpy as np
+
+from vector_store import LocalIndex, normalize_rows, top_k_indices
+
+SNAPSHOT_VERSION = 1
+# Variable-length fields, each stored as an offsets array plus a UTF-8 blob
+STRING_FIELDS = ("chunked_id", "content", "url", "topic_title")
+# Integer columns; missing values are stored as -1
+INT_FIELDS = ("topic_id", "post_id", "chunk_index", "total_chunks")
+# Rows scored per block when the matrix has to be upcast from float16
+SEARCH_BLOCK_ROWS = 65536
+# Rows buffered at a time while a snapshot is written
+WRITE_BLOCK_ROWS = 4096
+
+
+class StringColumn:
+    """Read-only list of strings backed by an offsets array and a byte blob."""
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+
+class SnapshotMetadata:
+    """Row i's metadata as a dict, built on access from the snapshot's columns."""
+
+    def __init__(self, strings: dict[str, StringColumn], ints: dict[str, np.ndarray]):
+        self.strings = strings
+        self.ints = ints
+
+    def __len__(self):
+        return len(self.strings["chunked_id"])
+
+    def __getitem__(self, i: int) -> dict:
+        metadata = {name: column[i] for name, column in self.strings.items() if name != "chunked_id"}
+        metadata.update({name: int(column[i]) for name, column in self.ints.items()})
+        return metadata
+
+
+def as_int(value) -> int:
+    # Pinecone returns numeric metadata as floats
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return -1
+
+
+def open_array(file: str, dtype, shape: tuple) -> np.ndarray:
+    """A .npy file mapped for writing; an empty one is just saved, as it cannot be mapped."""
+    if 0 in shape:
+        array = np.zeros(shape, dtype=dtype)
+        np.save(file, array)
+        return array
+    return np.lib.format.open_memmap(file, mode="w+", dtype=dtype, shape=shape)
+
+
+def flush_array(array: np.ndarray):
+    if isinstance(array, np.memmap):
+        array.flush()
+
+
+class StringColumnWriter:
+    """Appends strings to a column's blob and fills its offsets as it goes."""
+
+    def __init__(self, path: str, name: str, count: int):
+        self.offsets = open_array(os.path.join(path, f"{name}.offsets.npy"), np.int64, (count + 1,))
+        self.offsets[0] = 0
+        self.blob = open(os.path.join(path, f"{name}.blob"), "wb")
+        self.row = 0
+
+    def append(self, value: str):
+        encoded = value.encode("utf-8")
+        self.blob.write(encoded)
+        self.offsets[self.row + 1] = self.offsets[self.row] + len(encoded)
+        self.row += 1
+
+    def close(self):
+        self.blob.close()
+        flush_array(self.offsets)
+
+
+def write_snapshot_rows(
+    path: str,
+    count: int,
+    dimensions: int,
+    rows: Iterable[tuple[str, np.ndarray, dict]],
+    dtype: str = "float16",
+):
+    """
+    Writes a corpus snapshot directory from `count` (id, embedding, metadata)
+    rows, streamed straight into the files:
+
+        manifest.json                       count, dimensions, dtype, version
+        embeddings.npy                      row-normalized (count, dimensions) matrix
+        <field>.offsets.npy, <field>.blob   chunked_id, content, url, topic_title
+        <field>.npy                         topic_id, post_id, chunk_index, total_chunks
+
+    Only one block of rows is held in memory at a time. The directory is built
+    next to `path` and swapped in at the end, so a server loading the previous
+    snapshot never sees a half-written one.
+    """
+    tmp_path = path.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    matrix = open_array(os.path.join(tmp_path, "embeddings.npy"), dtype, (count, dimensions))
+    ints = {name: open_array(os.path.join(tmp_path, f"{name}.npy"), np.int64, (count,)) for name in INT_FIELDS}
+    strings = {name: StringColumnWriter(tmp_path, name, count) for name in STRING_FIELDS}
+
+    written, block = 0, []
+
+    def write_block():
+        vectors = np.asarray([embedding for _, embedding, _ in block], dtype=np.float32)
+        matrix[written : written + len(block)] = normalize_rows(vectors.reshape(len(block), dimensions))
+        for offset, (row_id, _, metadata) in enumerate(block):
+            strings["chunked_id"].append(row_id)
+            for name in STRING_FIELDS[1:]:
+                strings[name].append(str(metadata.get(name, "")))
+            for name in INT_FIELDS:
+                ints[name][written + offset] = as_int(metadata.get(name))
+
+    for row in rows:
+        if written + len(block) == count:
+            raise ValueError(f"More than the {count} rows announced for {path}")
+        block.append(row)
+        if len(block) == WRITE_BLOCK_ROWS:
+            write_block()
+            written, block = written + len(block), []
+    if block:
+        write_block()
+        written += len(block)
+    if written != count:
+        raise ValueError(f"Got {written} rows for {path}, expected {count}")
+
+    flush_array(matrix)
+    for column in ints.values():
+        flush_array(column)
+    for column in strings.values():
+        column.close()
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(
+            {"version": SNAPSHOT_VERSION, "count": count, "dimensions": dimensions, "dtype": dtype},
+            f,
+        )
+
+    old_path = path.rstrip("/") + ".old"
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def write_snapshot(path: str, ids: list[str], embeddings: np.ndarray, metadata: list[dict], dtype: str = "float16"):
+    """Writes an in-memory corpus as a snapshot, see write_snapshot_rows."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    dimensions = int(embeddings.shape[1]) if embeddings.ndim == 2 else 0
+    write_snapshot_rows(path, len(ids), dimensions, zip(ids, embeddings, metadata), dtype)
+
+
+class SnapshotIndex(LocalIndex):
+    """
+    Exact index over a snapshot directory, opened with np.memmap.
+
+    Nothing is copied or parsed at load time: the matrix, ids and metadata
+    are read straight from the mapped files on access, so several server
+    workers on one host share the same pages through the OS page cache.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.manifest['version']} in {path}")
+
+        def mapped(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        def blob(name: str) -> np.ndarray:
+            file = os.path.join(path, name)
+            if os.path.getsize(file) == 0:
+                return np.empty(0, dtype=np.uint8)
+            return np.memmap(file, dtype=np.uint8, mode="r")
+
+        self.embeddings = mapped("embeddings.npy")
+        strings = {
+            name: StringColumn(mapped(f"{name}.offsets.npy"), blob(f"{name}.blob"))
+            for name in STRING_FIELDS
+        }
+        ints = {name: mapped(f"{name}.npy") for name in INT_FIELDS}
+        self.ids = strings["chunked_id"]
+        self.metadata = SnapshotMetadata(strings, ints)
+
+    def __len__(self):
+        return self.manifest["count"]
+
+    def search(self, vector, top_k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        query = normalize_rows(np.asarray(vector, dtype=np.float32))
+        if self.embeddings.dtype == np.float32:
+            scores = self.embeddings @ query
+        else:
+            # Upcast in blocks so a float16 matrix is never copied whole
+            scores = np.empty(len(self.embeddings), dtype=np.float32)
+            for start in range(0, len(self.embeddings), SEARCH_BLOCK_ROWS):
+                block = self.embeddings[start : start + SEARCH_BLOCK_ROWS]
+                scores[start : start + len(block)] = block.astype(np.float32) @ query
+        indices = top_k_indices(scores, top_k)
+        return indices, scores[indices]
+
+    @classmethod
+    def load(cls, path: str, **kwargs):
+        return cls(path)
@@ -1,9 +1,17 @@
+import hashlib
+import io
+import json
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
+from google.genai import types
 from PIL import Image
-import pillow_avif
+import pillow_avif  # noqa: F401  registers the AVIF plugin with Pillow
 import re
-from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import mimetypes
 from urllib.parse import urlparse
@@ -11,6 +19,7 @@ from dotenv import load_dotenv
 from pydantic import BaseModel
 from transformers import AutoTokenizer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from cache import make_cache
 
 load_dotenv()
 
@@ -18,13 +27,36 @@ MAX_TOKENS_PER_CHUNK = 4096
 tokenizer = AutoTokenizer.from_pretrained("jinaai/jina-clip-v2")
 CHUNK_OVERLAP = 400
 
+# Token counts keyed by content hash, shared across topics (and runs with "disk")
+token_count_cache = make_cache(
+    os.getenv("TOKEN_CACHE_BACKEND", "memory"),
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "200000")),
+    path=os.getenv("TOKEN_CACHE_PATH", "token_cache.sqlite3"),
+)
+
+
+def count_tokens_uncached(text: str) -> int:
+    return len(tokenizer.encode(text))
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in text, memoized by a hash of its content."""
+    if token_count_cache is None:
+        return count_tokens_uncached(text)
+    key = hashlib.sha1(text.encode()).hexdigest()
+    count = token_count_cache.get(key)
+    if count is None:
+        count = count_tokens_uncached(text)
+        token_count_cache.set(key, count)
+    return count
+
 
 class ImageDescription(BaseModel):
     file_name: str
     description: str
 
 
-def download_image(url, filename, save_dir="images", with_ext=False):
+def download_image(url, filename, save_dir="images", with_ext=False, session=None):
     """
     Downloads an image from a URL and saves it with the correct extension.
 
@@ -32,11 +64,12 @@ def download_image(url, filename, save_dir="images", with_ext=False):
         url (str): The URL of the image to download.
         save_dir (str): The directory to save the image in.
         filename (str): Name of the file
+        session (requests.Session): Optional session to reuse pooled connections.
     """
     try:
         # --- 1. Make the request and check for errors ---
         # Using stream=True is efficient for downloading large files
-        response = requests.get(url, stream=True, timeout=15)
+        response = (session or requests).get(url, stream=True, timeout=15)
         response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
 
         # --- 2. Determine the file extension from the Content-Type header ---
@@ -96,27 +129,61 @@ GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY")
 BASE_URL = os.getenv("DISCOURSE_URL")
 client = genai.Client(api_key=GOOGLE_API_KEY)
 
-
-def describe_image_with_gemini(path_to_images: list[str], context_prompt: str) -> str:
+# Images are downscaled and re-encoded before upload, then packed into batches
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+DESCRIBE_BATCH_BYTES = int(os.getenv("DESCRIBE_BATCH_BYTES", str(4 * 1024 * 1024)))
+DESCRIBE_BATCH_MAX_IMAGES = int(os.getenv("DESCRIBE_BATCH_MAX_IMAGES", "8"))
+
+# Image descriptions keyed by image content hash, persisted across runs
+description_store = make_cache(
+    "disk",
+    maxsize=int(os.getenv("DESCRIPTION_STORE_SIZE", "1000000")),
+    path=os.getenv("DESCRIPTION_STORE_PATH", "image_descriptions.sqlite3"),
+)
+
+
+def prepare_image(path: str, max_side: int = IMAGE_MAX_SIDE) -> types.Part:
+    """Downscales an image to at most max_side pixels and re-encodes it as JPEG."""
+    img = Image.open(path)
+    img.thumbnail((max_side, max_side))
+    if img.mode != "RGB":
+        background = Image.new("RGB", img.size, "white")
+        rgba = img.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        img = background
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return types.Part.from_bytes(data=buffer.getvalue(), mime_type="image/jpeg")
+
+
+def describe_image_with_gemini(
+    path_to_images: list[str], context_prompt: str, prepared: list[types.Part] | None = None
+) -> str:
     """
         Uses the Gemini 1.5 Flash model to describe an image from a local path.
 
         Args:
             image_path (str): The local file path to the image.
         context_prompt (str): The text prompt providing context for the image.
+        prepared (list[types.Part]): Already prepared images, skips prepare_image.
 
     Returns:
         str: A detailed text description of the image, or an error message.
     """
     # try:
-    # Load the image using Pillow
-    imgs = [Image.open(x).convert("RGBA") for x in path_to_images]
+    # Downscale and re-encode so the request stays small
+    imgs = prepared or [prepare_image(x) for x in path_to_images]
 
     # Select the model. 'gemini-1.5-flash-latest' is perfect for "lite" and fast use.
     # It's highly capable and cost-effective.
+    # Each image is preceded by its file name so descriptions can be matched back
+    labelled = []
+    for path, img in zip(path_to_images, imgs):
+        labelled.extend([f"File name: {os.path.basename(path)}", img])
     response = client.models.generate_content(
         model="gemini-2.0-flash-lite",
-        contents=[context_prompt, *imgs],
+        contents=[context_prompt, *labelled],
         config={
             "response_mime_type": "application/json",
             "response_schema": list[ImageDescription],
@@ -145,37 +212,280 @@ def describe_image_with_gemini(path_to_images: list[str], context_prompt: str) -
 # (Assume the describe_image_with_gemini function from above is in the same file)
 
 
-def download_image_from_markdown(markdown_text, id, savedir):
-    image_pattern = re.compile(r"!\[(.*?)\]\((.*?)\)")
+def image_key(path: str) -> str:
+    """
+    Name an image is referenced by in markdown: the upload short-url without
+    its extension, with the '<post_id>_' prefix added at download time removed.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return re.sub(r"^\d+_", "", stem)
+
+
+def batch_images(
+    paths: list[str], max_bytes: int, max_images: int
+) -> list[list[tuple[str, types.Part]]]:
+    """Packs prepared images into batches bounded by their total upload size."""
+    batches, current, current_bytes = [], [], 0
+    for path in paths:
+        part = prepare_image(path)
+        size = len(part.inline_data.data)
+        if current and (current_bytes + size > max_bytes or len(current) >= max_images):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append((path, part))
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def describe_images(path_to_images: list[str], context_prompt: str) -> dict[str, str]:
+    """
+    Describes images with Gemini, only for content not already in the
+    description store. Returns descriptions keyed by image_key.
+    """
+    hashes = {path: file_sha256(path) for path in path_to_images}
+    descriptions, pending = {}, []
+    for path, digest in hashes.items():
+        cached = description_store.get("hash:" + digest)
+        if cached is None:
+            pending.append(path)
+        else:
+            descriptions[image_key(path)] = cached
+        description_store.set("name:" + image_key(path), digest)
 
-    matches = list(image_pattern.finditer(markdown_text))
-    print(matches)
+    # Identical content under several names only needs describing once
+    unique = list({hashes[path]: path for path in pending}.values())
+    print(f"Describing {len(unique)} of {len(path_to_images)} images")
 
-    if len(matches) == 0:
-        print("No images to download")
-        return
+    for prepared_batch in batch_images(unique, DESCRIBE_BATCH_BYTES, DESCRIBE_BATCH_MAX_IMAGES):
+        batch = [path for path, _ in prepared_batch]
+        response = describe_image_with_gemini(
+            batch, context_prompt, prepared=[part for _, part in prepared_batch]
+        )
+        by_name = {os.path.basename(path): path for path in batch}
+        described = set()
+        for result in response.parsed or []:
+            # Only trust results that name their image; a guess by position
+            # would be stored under the wrong content hash for good
+            path = by_name.get(result.file_name)
+            if path is not None:
+                description_store.set("hash:" + hashes[path], result.description)
+                described.add(path)
+        if len(described) < len(batch):
+            print(f"{len(batch) - len(described)} images left undescribed, will retry next run")
+
+    for path in pending:
+        cached = description_store.get("hash:" + hashes[path])
+        if cached is not None:
+            descriptions[image_key(path)] = cached
+    return descriptions
+
+
+def get_stored_description(key: str) -> str | None:
+    digest = description_store.get("name:" + key)
+    if digest is None:
+        return None
+    return description_store.get("hash:" + digest)
 
-    print("Found", len(matches), "images")
-    for i, match in enumerate(reversed(matches), start=1):
-        alt_text = match.group(1)
-        download_path = match.group(2)
-        download_url = (
-            BASE_URL + "/uploads/short-url/" + download_path.removeprefix("upload://")
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+DOWNLOAD_RATE_PER_HOST = float(os.getenv("DOWNLOAD_RATE_PER_HOST", "5"))
+DOWNLOAD_PROGRESS_FILE = ".download_progress.json"
+
+
+class HostRateLimiter:
+    """Spaces out requests so each host sees at most `rate` requests per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_slot: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ImageDownloader:
+    """
+    Concurrent downloader for Discourse `upload://` images.
+
+    Each short-url is fetched once per run through a shared pooled session and
+    a per-host rate limiter; files already on disk are skipped, other posts
+    referencing the same upload get a hard link, and identical content under
+    different short-urls is stored once. Completed short-urls are recorded in
+    a progress file in `savedir` so an interrupted crawl resumes where it left off.
+    """
+
+    def __init__(
+        self,
+        savedir: str,
+        max_workers: int = DOWNLOAD_WORKERS,
+        rate_per_host: float = DOWNLOAD_RATE_PER_HOST,
+    ):
+        self.savedir = savedir
+        self.max_workers = max_workers
+        self.rate_limiter = HostRateLimiter(rate_per_host)
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
         )
-        print(f"Downloading image {i} of {len(matches)}")
-        download_image(
-            download_url,
-            str(id) + "_" + download_path.removeprefix("upload://"),
-            savedir,
-            with_ext=True,
+        self.progress_path = os.path.join(savedir, DOWNLOAD_PROGRESS_FILE)
+        self._lock = threading.Lock()
+        os.makedirs(savedir, exist_ok=True)
+        self.progress: dict[str, dict] = {}
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                self.progress = json.load(f)
+        self.paths_by_hash = {
+            entry["sha256"]: entry["path"] for entry in self.progress.values()
+        }
+
+    def _save_progress(self):
+        tmp_path = self.progress_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.progress, f)
+        os.replace(tmp_path, self.progress_path)
+
+    def _existing_path(self, short_url: str) -> str | None:
+        entry = self.progress.get(short_url)
+        if entry and os.path.exists(entry["path"]):
+            return entry["path"]
+        return None
+
+    def _fetch(self, short_url: str, filenames: list[str]):
+        url = BASE_URL + "/uploads/short-url/" + short_url
+        self.rate_limiter.wait(url)
+        path = download_image(
+            url, filenames[0], self.savedir, with_ext=True, session=self.session
         )
-        print("Downloaded successfully")
+        if path is None:
+            return None
+        digest = file_sha256(path)
+        with self._lock:
+            duplicate = self.paths_by_hash.get(digest)
+            if duplicate and duplicate != path and os.path.exists(duplicate):
+                os.remove(path)
+                link_or_copy(duplicate, path)
+            else:
+                self.paths_by_hash[digest] = path
+            self.progress[short_url] = {"path": path, "sha256": digest}
+            self._save_progress()
+        return path
+
+    def _link_targets(self, source: str, filenames: list[str]):
+        for filename in filenames:
+            target = os.path.join(self.savedir, filename)
+            if not os.path.exists(target):
+                link_or_copy(source, target)
+
+    def download(self, items: list[tuple[str, str]]) -> dict[str, int]:
+        """
+        Downloads (short_url, filename) pairs, where short_url has the
+        `upload://` prefix stripped. Returns counts of what was done.
+        """
+        targets: dict[str, list[str]] = {}
+        for short_url, filename in items:
+            targets.setdefault(short_url, [])
+            if filename not in targets[short_url]:
+                targets[short_url].append(filename)
+
+        stats = {"downloaded": 0, "skipped": 0, "linked": 0, "failed": 0}
+        pending = {}
+        for short_url, filenames in targets.items():
+            missing = [
+                x for x in filenames if not os.path.exists(os.path.join(self.savedir, x))
+            ]
+            if not missing:
+                stats["skipped"] += 1
+                continue
+            existing = self._existing_path(short_url) or next(
+                (
+                    os.path.join(self.savedir, x)
+                    for x in filenames
+                    if os.path.exists(os.path.join(self.savedir, x))
+                ),
+                None,
+            )
+            if existing:
+                self._link_targets(existing, missing)
+                stats["linked"] += 1
+            else:
+                pending[short_url] = missing
+
+        print(f"Downloading {len(pending)} of {len(targets)} images")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {
+                short_url: pool.submit(self._fetch, short_url, filenames)
+                for short_url, filenames in pending.items()
+            }
+            for short_url, future in futures.items():
+                path = future.result()
+                if path is None:
+                    stats["failed"] += 1
+                    continue
+                self._link_targets(path, pending[short_url][1:])
+                stats["downloaded"] += 1
+
+        print(f"Image download finished: {stats}")
+        return stats
+
+
+def find_markdown_images(markdown_text: str, id) -> list[tuple[str, str]]:
+    """(short_url, filename) pairs for every upload:// image in a post."""
+    image_pattern = re.compile(r"!\[(.*?)\]\((.*?)\)")
+    items = []
+    for match in image_pattern.finditer(markdown_text):
+        download_path = match.group(2)
+        if not download_path.startswith("upload://"):
+            continue
+        short_url = download_path.removeprefix("upload://")
+        items.append((short_url, str(id) + "_" + short_url))
+    return items
+
+
+def download_images_from_posts(posts: list[tuple[str, int]], savedir):
+    """Downloads the images of many (markdown_text, post_id) pairs in one concurrent pass."""
+    items = []
+    for markdown_text, id in posts:
+        items.extend(find_markdown_images(markdown_text, id))
+    if len(items) == 0:
+        print("No images to download")
+        return
+    print("Found", len(items), "images")
+    return ImageDownloader(savedir).download(items)
 
 
-def embed_image_descriptions(chunk: str, descriptions: dict[str, str]):
+def download_image_from_markdown(markdown_text, id, savedir):
+    return download_images_from_posts([(markdown_text, id)], savedir)
+
+
+def embed_image_descriptions(chunk: str, descriptions: dict[str, str] | None = None):
     """
     Finds all image tags in markdown, generates descriptions using Gemini,
-    and rewrites the text.
+    and rewrites the text. Without `descriptions`, they are read from the
+    description store filled by describe_images.
     """
     image_pattern = re.compile(r"!\[(.*?)\]\((.*?)\)")
 
@@ -184,9 +494,11 @@ def embed_image_descriptions(chunk: str, descriptions: dict[str, str]):
     for match in reversed(matches):
         image_path = match.group(2)
         # print(image_path)
-        image_description = descriptions.get(
-            image_path.removeprefix("upload://").split(".")[0], "None"
-        )
+        key = image_path.removeprefix("upload://").split(".")[0]
+        if descriptions is None:
+            image_description = get_stored_description(key) or "None"
+        else:
+            image_description = descriptions.get(key, "None")
 
         enriched_tag = f"\n[Image Description: {image_description.strip()}]\n"
 
@@ -208,20 +520,22 @@ def build_reply_hierarchy(flat_posts: list[dict]) -> list[dict]:
 
     Returns:
         A list of top-level post dictionaries, with child posts nested
-        under a 'replies' key.
+        under a 'replies' key. The nodes are shallow copies, so the input
+        posts are left unchanged.
     """
     post_map = {}
+    nodes = []
 
-    # --- First Pass: Map all posts by their ID and initialize 'replies' list ---
+    # --- First Pass: Map a copy of every post by its ID, with an empty 'replies' list ---
     for post in flat_posts:
-        post_id = post["post_number"]
-        post["replies"] = []  # Add the replies list to each post object
-        post_map[post_id] = post
+        node = {**post, "replies": []}
+        post_map[node["post_number"]] = node
+        nodes.append(node)
 
     hierarchy = []
 
     # --- Second Pass: Connect replies to their parents ---
-    for post in flat_posts:
+    for post in nodes:
         parent_id = post.get("reply_to_post_number")  # Use .get() for safety
 
         if parent_id is not None:
@@ -301,7 +615,74 @@ def create_contextual_chunks(nested_threads: list[dict]) -> list[dict]:
     return all_chunks
 
 
-def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
+def chunk_content_hash(content: str, url: str) -> str:
+    """
+    Hash of everything that ends up in a chunk's vector and metadata. Parent
+    context is part of the content, so edits propagate to every descendant.
+    """
+    return hashlib.sha256(f"{url}\n{content}".encode()).hexdigest()
+
+
+def format_hierarchical_post(node: dict, depth: int) -> str:
+    prefix = ">" * depth + " " if depth else ""
+    return f"{prefix}Post {node['id']}: {node['raw']}"
+
+
+def pretokenize_threads(nested_threads: list[dict], batch_size: int = 1024) -> dict:
+    """
+    Tokenizes every string create_hierarchical_chunks will measure whole
+    (formatted posts and topic headers) in batched fast-tokenizer calls and
+    seeds the token count cache with the results. Monolith posts are split on
+    fragments, not their raw text, so raw text is not pre-tokenized.
+
+    Args:
+        nested_threads: Output of build_reply_hierarchy, for one or many topics.
+        batch_size: Number of texts per tokenizer call.
+
+    Returns:
+        Throughput stats: texts, tokens, seconds and tokens_per_sec.
+    """
+    if token_count_cache is None:
+        print("Token count cache is disabled, skipping pre-tokenization")
+        return {"texts": 0, "tokens": 0, "seconds": 0.0, "tokens_per_sec": 0.0}
+
+    texts = {}
+
+    def collect(node: dict, depth: int):
+        for text in (format_hierarchical_post(node, depth), f"Topic: {node['title']}"):
+            texts.setdefault(hashlib.sha1(text.encode()).hexdigest(), text)
+        for reply in node.get("replies", []):
+            collect(reply, depth + 1)
+
+    for thread_start_node in nested_threads:
+        collect(thread_start_node, 0)
+
+    pending = [(key, text) for key, text in texts.items() if token_count_cache.get(key) is None]
+
+    total_tokens = 0
+    start = time.perf_counter()
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i : i + batch_size]
+        encoded = tokenizer([text for _, text in batch])["input_ids"]
+        # One write per tokenizer call, which matters for the disk cache
+        token_count_cache.set_many({key: len(ids) for (key, _), ids in zip(batch, encoded)})
+        total_tokens += sum(len(ids) for ids in encoded)
+    seconds = time.perf_counter() - start
+
+    stats = {
+        "texts": len(pending),
+        "tokens": total_tokens,
+        "seconds": seconds,
+        "tokens_per_sec": total_tokens / seconds if seconds else 0.0,
+    }
+    print(
+        f"Pre-tokenized {stats['texts']} texts ({stats['tokens']} tokens) "
+        f"in {seconds:.2f}s, {stats['tokens_per_sec']:.0f} tokens/sec"
+    )
+    return stats
+
+
+def create_hierarchical_chunks(nested_threads: list[dict], pretokenize: bool = True) -> list[dict]:
     """
     The master function to create optimized, hierarchical chunks for a large-context RAG system.
 
@@ -311,18 +692,22 @@ def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
     3.  If a single post's text *itself* exceeds the limit, it splits that post
         into linked sub-chunks.
 
+    Pass pretokenize=False when pretokenize_threads already ran over these
+    threads, e.g. as part of a batch of topics.
+
     Returns:
         A flat list of dictionaries, each a chunk ready for embedding and upserting.
     """
     all_final_chunks = []
 
-    def process_node(node: dict, parent_history: list[str]):
-        # parent_history is a list of formatted parent strings, e.g., ["Post 101: ...", "> Post 102: ..."]
+    def process_node(node: dict, parent_history: list[tuple[str, int]]):
+        # parent_history is a list of (formatted parent string, token count) pairs,
+        # e.g., [("Post 101: ...", 12), ("> Post 102: ...", 30)], so every post is
+        # tokenized once no matter how deep its descendants go
 
         current_post_text = node["raw"]
         current_post_id = node["id"]
-        prefix = ">" * len(parent_history) + " " if parent_history else ""
-        formatted_current_post = f"{prefix}Post {current_post_id}: {current_post_text}"
+        formatted_current_post = format_hierarchical_post(node, len(parent_history))
 
         # --- Token Budgeting for Hierarchy ---
         context_parts = []
@@ -330,7 +715,7 @@ def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
 
         # 1. Add current post's text to the budget first
         # We must check if the current post *alone* is too big
-        current_post_tokens = len(tokenizer.encode(formatted_current_post))
+        current_post_tokens = count_tokens(formatted_current_post)
 
         if current_post_tokens > MAX_TOKENS_PER_CHUNK:
             # --- STRATEGY A: HANDLE MONOLITH POST (Self-Splitting) ---
@@ -362,10 +747,13 @@ def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
                         "total_chunks": total_splits,
                         "content": final_chunk_text,
                         "url": node["url"],
+                        "content_hash": chunk_content_hash(final_chunk_text, node["url"]),
                     }
                 )
             # After splitting, continue recursion with the monolith's *full text* as history for its children
-            new_history_for_children = parent_history + [formatted_current_post]
+            new_history_for_children = parent_history + [
+                (formatted_current_post, current_post_tokens)
+            ]
             for reply in node.get("replies", []):
                 process_node(reply, new_history_for_children)
             return  # Stop further processing for this monolith node itself
@@ -375,8 +763,7 @@ def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
         token_budget -= current_post_tokens
 
         # 2. Add parent context (most recent first) until budget is full
-        for parent_text in reversed(parent_history):
-            parent_tokens = len(tokenizer.encode(parent_text))
+        for parent_text, parent_tokens in reversed(parent_history):
             if token_budget - parent_tokens > 0:
                 context_parts.append(parent_text)
                 token_budget -= parent_tokens
@@ -385,7 +772,7 @@ def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
 
         # 3. Add Topic Title if it fits
         topic_header = f"Topic: {node['title']}"
-        if token_budget - len(tokenizer.encode(topic_header)) > 0:
+        if token_budget - count_tokens(topic_header) > 0:
             context_parts.append(topic_header)
 
         # Build the final chunk text in correct chronological order
@@ -401,19 +788,22 @@ def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
                 "total_chunks": 1,
                 "content": final_chunk_text,
                 "url": node["url"],
+                "content_hash": chunk_content_hash(final_chunk_text, node["url"]),
             }
         )
 
         # --- Recurse for children ---
-        new_history_for_children = parent_history + [formatted_current_post]
+        new_history_for_children = parent_history + [
+            (formatted_current_post, current_post_tokens)
+        ]
         for reply in node.get("replies", []):
             process_node(reply, new_history_for_children)
 
     # --- Helper sub-functions ---
-    def build_parent_context(history: list[str], budget: int) -> str:
+    def build_parent_context(history: list[tuple[str, int]], budget: int) -> str:
         parts = []
-        for parent_text in reversed(history):
-            if budget - len(tokenizer.encode(parent_text)) > 0:
+        for parent_text, parent_tokens in reversed(history):
+            if budget - parent_tokens > 0:
                 parts.append(parent_text)
             else:
                 break
@@ -423,11 +813,16 @@ def create_hierarchical_chunks(nested_threads: list[dict]) -> list[dict]:
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=MAX_TOKENS_PER_CHUNK - 500,  # Leave room for headers
             chunk_overlap=CHUNK_OVERLAP,
-            length_function=lambda txt: len(tokenizer.encode(txt)),
+            # Fragments and merge candidates are measured once each, so
+            # caching them would only add hashing and cache writes
+            length_function=count_tokens_uncached,
         )
         return text_splitter.split_text(text)
 
     # --- Start the process for each top-level thread ---
+    # One batched tokenizer pass up front instead of one call per string
+    if pretokenize:
+        pretokenize_threads(nested_threads)
     for thread_start_node in nested_threads:
         process_node(thread_start_node, parent_history=[])
 
@@ -0,0 +1,294 @@
+import json
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k highest scores, best first."""
+    top_k = min(top_k, len(scores))
+    if top_k == 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class LocalIndex:
+    """
+    Exact in-memory cosine index with the same query interface as a Pinecone index.
+
+    Embeddings are stored row-normalized as one float32 matrix, so a query is a
+    single matrix-vector product followed by argpartition.
+    """
+
+    def __init__(self, ids: list[str], embeddings: np.ndarray, metadata: list[dict]):
+        self.ids = list(ids)
+        self.embeddings = normalize_rows(embeddings)
+        self.metadata = list(metadata)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, vector, top_k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        query = normalize_rows(np.asarray(vector, dtype=np.float32))
+        scores = self.embeddings @ query
+        indices = top_k_indices(scores, top_k)
+        return indices, scores[indices]
+
+    def build_response(self, indices, scores, include_metadata: bool = True) -> dict:
+        matches = []
+        for i, score in zip(indices, scores):
+            match = {"id": self.ids[i], "score": float(score)}
+            if include_metadata:
+                match["metadata"] = self.metadata[i]
+            matches.append(match)
+        return {"matches": matches}
+
+    def query(self, vector, top_k: int = 10, include_metadata: bool = False, **kwargs) -> dict:
+        indices, scores = self.search(vector, top_k)
+        return self.build_response(indices, scores, include_metadata)
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            ids=np.array(self.ids),
+            embeddings=self.embeddings,
+            metadata=np.array(json.dumps(self.metadata)),
+        )
+
+    @classmethod
+    def load(cls, path: str, **kwargs):
+        data = np.load(path)
+        return cls(
+            ids=data["ids"].tolist(),
+            embeddings=data["embeddings"],
+            metadata=json.loads(str(data["metadata"])),
+            **kwargs,
+        )
+
+
+class IVFIndex(LocalIndex):
+    """
+    Approximate index for larger corpora using an inverted file.
+
+    Rows are clustered with k-means into `n_lists` lists; a query scans only
+    the `n_probe` lists whose centroids are closest to it.
+    """
+
+    def __init__(
+        self,
+        ids: list[str],
+        embeddings: np.ndarray,
+        metadata: list[dict],
+        n_lists: int | None = None,
+        n_probe: int = 8,
+        iterations: int = 10,
+        seed: int = 0,
+    ):
+        super().__init__(ids, embeddings, metadata)
+        n_lists = n_lists or max(1, int(np.sqrt(len(self.ids))))
+        self.n_probe = n_probe
+        self.centroids, assignments = self._kmeans(n_lists, iterations, seed)
+        self.lists = [np.flatnonzero(assignments == i) for i in range(len(self.centroids))]
+
+    def _kmeans(self, n_lists: int, iterations: int, seed: int):
+        rng = np.random.default_rng(seed)
+        n_lists = min(n_lists, len(self.embeddings))
+        if n_lists == 0:
+            return np.empty((0, self.embeddings.shape[1]), dtype=np.float32), np.empty(0)
+        centroids = self.embeddings[rng.choice(len(self.embeddings), n_lists, replace=False)]
+        assignments = np.zeros(len(self.embeddings), dtype=np.int64)
+        for _ in range(iterations):
+            assignments = np.argmax(self.embeddings @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = self.embeddings[assignments == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+        return centroids, assignments
+
+    def probe(self, query: np.ndarray) -> np.ndarray:
+        """Rows in the n_probe lists closest to a normalized query."""
+        probes = top_k_indices(self.centroids @ query, self.n_probe)
+        return np.concatenate([self.lists[i] for i in probes]) if len(probes) else np.empty(0, dtype=np.int64)
+
+    def search(self, vector, top_k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        query = normalize_rows(np.asarray(vector, dtype=np.float32))
+        candidates = self.probe(query)
+        scores = self.embeddings[candidates] @ query
+        order = top_k_indices(scores, top_k)
+        return candidates[order], scores[order]
+
+
+# Number of set bits in every byte value, for Hamming distances on packed codes
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+QUANTIZED_BLOCK_ROWS = 65536
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(values)
+    return POPCOUNT[values]
+
+
+class QuantizedIndex:
+    """
+    Two-pass search over another index's vectors.
+
+    The first pass scores compact codes of the first `truncate_dim` dimensions
+    (jina-clip-v2 is trained Matryoshka-style, so a prefix is itself a usable
+    embedding): "int8" keeps per-dimension scaled integers, "binary" one sign
+    bit per dimension compared by Hamming distance. The best `rescore_k`
+    candidates are then rescored with the base index's full-precision vectors,
+    which can stay memory-mapped (see snapshot.py) since only those rows are read.
+    Over an IVFIndex, the first pass only scores the codes in the probed lists.
+    """
+
+    def __init__(self, base: LocalIndex, mode: str = "int8", truncate_dim: int | None = 256, rescore_k: int = 100):
+        if mode not in ("int8", "binary"):
+            raise ValueError(f"Unknown quantization mode: {mode}")
+        self.base = base
+        self.mode = mode
+        self.truncate_dim = min(truncate_dim or base.embeddings.shape[1], base.embeddings.shape[1])
+        self.rescore_k = rescore_k
+        self.ids = base.ids
+        self.metadata = base.metadata
+        self.codes, self.scale = self._encode()
+
+    def __len__(self):
+        return len(self.base)
+
+    def _prefixes(self):
+        for start in range(0, len(self.base.embeddings), QUANTIZED_BLOCK_ROWS):
+            block = self.base.embeddings[start : start + QUANTIZED_BLOCK_ROWS, : self.truncate_dim]
+            yield normalize_rows(block)
+
+    def _encode(self) -> tuple[np.ndarray, np.ndarray | None]:
+        if self.mode == "binary":
+            return np.concatenate([np.packbits(x > 0, axis=1) for x in self._prefixes()]), None
+        # Symmetric per-dimension scale from the largest magnitude seen
+        scale = np.zeros(self.truncate_dim, dtype=np.float32)
+        for block in self._prefixes():
+            scale = np.maximum(scale, np.abs(block).max(axis=0))
+        scale = np.where(scale > 0, 127 / scale, 1).astype(np.float32)
+        codes = np.concatenate(
+            [np.clip(np.rint(x * scale), -127, 127).astype(np.int8) for x in self._prefixes()]
+        )
+        return codes, scale
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the first-pass codes."""
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def first_pass(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """Approximate scores of every row, or only of `rows` if given (in that order)."""
+        prefix = normalize_rows(query[: self.truncate_dim])
+        codes = self.codes if rows is None else self.codes[rows]
+        scores = np.empty(len(codes), dtype=np.float32)
+        if self.mode == "binary":
+            bits = np.packbits(prefix > 0)
+            for start in range(0, len(codes), QUANTIZED_BLOCK_ROWS):
+                block = codes[start : start + QUANTIZED_BLOCK_ROWS]
+                scores[start : start + len(block)] = -popcount(block ^ bits).sum(axis=1, dtype=np.int32)
+        else:
+            # codes / scale approximates the prefix, so fold the scale into the query
+            scaled = prefix / self.scale
+            for start in range(0, len(codes), QUANTIZED_BLOCK_ROWS):
+                block = codes[start : start + QUANTIZED_BLOCK_ROWS]
+                scores[start : start + len(block)] = block.astype(np.float32) @ scaled
+        return scores
+
+    def search(self, vector, top_k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        query = normalize_rows(np.asarray(vector, dtype=np.float32))
+        rows = self.base.probe(query) if isinstance(self.base, IVFIndex) else None
+        candidates = top_k_indices(self.first_pass(query, rows), max(top_k, self.rescore_k))
+        if rows is not None:
+            candidates = rows[candidates]
+        # Sorted row order keeps reads from a memory-mapped matrix sequential
+        candidates = np.sort(candidates)
+        scores = np.asarray(self.base.embeddings[candidates], dtype=np.float32) @ query
+        order = top_k_indices(scores, top_k)
+        return candidates[order], scores[order]
+
+    def query(self, vector, top_k: int = 10, include_metadata: bool = False, **kwargs) -> dict:
+        indices, scores = self.search(vector, top_k)
+        return self.base.build_response(indices, scores, include_metadata)
+
+
+def fuse_results(
+    results: list, weights: list[float], method: str = "rrf", top_k: int = 10, rrf_k: int = 60
+) -> dict:
+    """
+    Merges several query responses into one ranked list of matches.
+
+    "rrf" scores each match by sum(weight / (rrf_k + rank)); "weighted" by the
+    weighted sum of its similarity scores. Returned matches carry the fused score.
+    """
+    fused: dict[str, float] = {}
+    matches: dict[str, dict] = {}
+    for response, weight in zip(results, weights):
+        for rank, match in enumerate(response["matches"], start=1):
+            match_id = match["id"]
+            if method == "rrf":
+                score = weight / (rrf_k + rank)
+            elif method == "weighted":
+                score = weight * match["score"]
+            else:
+                raise ValueError(f"Unknown fusion method: {method}")
+            fused[match_id] = fused.get(match_id, 0.0) + score
+            matches.setdefault(match_id, match)
+    ranked = sorted(fused, key=fused.get, reverse=True)[:top_k]
+    return {
+        "matches": [
+            {"id": x, "score": fused[x], "metadata": matches[x]["metadata"]} for x in ranked
+        ]
+    }
+
+
+def load_local_index(path: str, kind: str = "exact", **kwargs) -> LocalIndex:
+    """
+    Loads a saved index as an exact ("exact") or approximate ("ivf") index, or
+    memory-maps a snapshot directory written by snapshot.write_snapshot ("snapshot").
+    """
+    if kind == "snapshot":
+        from snapshot import SnapshotIndex
+
+        return SnapshotIndex.load(path)
+    if kind == "exact":
+        return LocalIndex.load(path)
+    if kind == "ivf":
+        return IVFIndex.load(path, **kwargs)
+    raise ValueError(f"Unknown local index kind: {kind}")
+
+
+def export_from_pinecone(index, namespace: str, batch_size: int = 100) -> LocalIndex:
+    """Copies every vector and its metadata out of a Pinecone namespace."""
+    ids, embeddings, metadata = [], [], []
+    for page in index.list(namespace=namespace, limit=batch_size):
+        fetched = index.fetch(ids=list(page), namespace=namespace).vectors
+        for vector_id, vector in fetched.items():
+            ids.append(vector_id)
+            embeddings.append(vector.values)
+            metadata.append(dict(vector.metadata or {}))
+    return LocalIndex(ids, np.array(embeddings, dtype=np.float32), metadata)
+
+
+if __name__ == "__main__":
+    import os
+    from dotenv import load_dotenv
+    from pinecone import Pinecone
+
+    load_dotenv()
+    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+    local = export_from_pinecone(
+        pc.Index(os.getenv("PINECONE_INDEX_NAME")), os.getenv("PINECONE_NAMESPACE")
+    )
+    local.save(os.getenv("LOCAL_INDEX_PATH", "index.npz"))
+    print(f"Exported {len(local)} vectors")